@@ -0,0 +1,248 @@
+#! /usr/bin/env python3
+""" Times the hot paths of the engine, the cards, persistence and rendering.
+
+Results go to a JSON file and are compared against a saved baseline:
+    python benchmarks/run.py --save-baseline      # on the reference commit
+    python benchmarks/run.py                      # later, reports the ratios"""
+
+import argparse
+import json
+import os
+import pickle
+import platform
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pymus"))
+
+import codec
+import mus
+import simulator
+
+try:
+    import telegram
+except ImportError:
+    telegram = None
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SEED = 1234
+
+BENCHMARKS = {}
+
+
+def benchmark(function):
+    """Registers a setup function returning the callable to time."""
+    BENCHMARKS[function.__name__] = function
+    return function
+
+
+def hands(hand_type):
+    packet = mus.Packet(SEED)
+    return [hand_type(sorted(packet.take(4))) for _ in range(2)]
+
+
+def compare(hand_type):
+    hand_1, hand_2 = hands(hand_type)
+    return lambda: hand_1 < hand_2
+
+
+@benchmark
+def haundia_compare():
+    return compare(mus.HaundiaHand)
+
+
+@benchmark
+def tipia_compare():
+    return compare(mus.TipiaHand)
+
+
+@benchmark
+def pariak_compare():
+    return compare(mus.PariakHand)
+
+
+@benchmark
+def jokua_compare():
+    return compare(mus.JokuaHand)
+
+
+@benchmark
+def packet_take():
+    packet = mus.Packet(SEED)
+
+    def take():
+        # Nothing is traded back, the packet is dealt again when a hand no longer fits in it
+        if packet.n_unused < 4:
+            packet.restore()
+        return packet.take(4)
+    return take
+
+
+@benchmark
+def packet_trade():
+    packet = mus.Packet(SEED)
+    hand = packet.take(4)
+
+    def trade():
+        hand[0] = packet.trade(hand[0])[0]
+    return trade
+
+
+def play_hand(seed=SEED):
+    """Plays from the deal until the end of the first hand, with seeded random policies."""
+    policies = [simulator.RandomPolicy() for _ in range(4)]
+    game = simulator.new_game(policies, seed)
+    while game.current != "Finished":
+        simulator.play_move(game, policies)
+    return game
+
+
+@benchmark
+def full_hand():
+    return play_hand
+
+
+def mid_game():
+    """A seeded 4 player game in the middle of its first betting lance, once somebody spoke."""
+    policies = [simulator.RandomPolicy() for _ in range(4)]
+    game = simulator.new_game(policies, SEED)
+    while game.current not in mus.Game.bet_states or not game.state.history:
+        simulator.play_move(game, policies)
+    return game
+
+
+@benchmark
+def pickle_dumps():
+    game = mid_game()
+    return lambda: pickle.dumps(game)
+
+
+@benchmark
+def pickle_loads():
+    data = pickle.dumps(mid_game())
+    return lambda: pickle.loads(data)
+
+
+@benchmark
+def codec_encode():
+    game = mid_game()
+    return lambda: codec.encode(game)
+
+
+@benchmark
+def codec_decode():
+    data = codec.encode(mid_game())
+    return lambda: codec.decode(data)
+
+
+def handler():
+    if telegram is None:
+        return None
+    # Rendering needs neither the Telegram API nor a storage connection
+    return telegram.HordagoTelegramHandler("0:benchmark")
+
+
+@benchmark
+def compute_message():
+    bot, game = handler(), mid_game()
+    return bot and (lambda: bot.compute_message(game))
+
+
+def late_game():
+    """A seeded 4 player game in one of the last betting lances, after the first ones were played."""
+    policies = [simulator.RandomPolicy() for _ in range(4)]
+    game = simulator.new_game(policies, SEED)
+    while game.current not in mus.Game.bet_states[2:]:
+        simulator.play_move(game, policies)
+    return game
+
+
+@benchmark
+def compute_message_late():
+    bot, game = handler(), late_game()
+    return bot and (lambda: bot.compute_message(game))
+
+
+@benchmark
+def compute_message_finished():
+    bot, game = handler(), play_hand()
+    return bot and (lambda: bot.compute_message(game))
+
+
+@benchmark
+def compute_keyboard():
+    bot, game = handler(), mid_game()
+    return bot and (lambda: bot.compute_keyboard(game))
+
+
+def measure(function, repeat):
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def run(names, repeat):
+    results = {}
+    for name in names:
+        function = BENCHMARKS[name]()
+        if function is None:
+            print("{:<28} skipped (missing dependency)".format(name))
+            continue
+        results[name] = measure(function, repeat) * 1e6
+    return results
+
+
+def report(results, baseline, threshold):
+    regressions = []
+    print("{:<28} {:>12} {:>12} {:>8}".format("benchmark", "baseline us", "current us", "ratio"))
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            print("{:<28} {:>12} {:>12.3f} {:>8}".format(name, "-", current, "-"))
+            continue
+        ratio = current / previous
+        flag = " <-- regression" if ratio > threshold else ""
+        print("{:<28} {:>12.3f} {:>12.3f} {:>8.2f}{}".format(name, previous, current, ratio, flag))
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("names", nargs="*", help="Benchmarks to run, all by default", default=sorted(BENCHMARKS))
+    parser.add_argument("-o", "--output", default=os.path.join(HERE, "results.json"),
+                        help="Where to write the results")
+    parser.add_argument("-b", "--baseline", default=os.path.join(HERE, "baseline.json"),
+                        help="Results to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="Write the results as the new baseline")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Timing repeats, the best one is kept")
+    parser.add_argument("-t", "--threshold", type=float, default=1.2,
+                        help="Ratio to the baseline above which a benchmark is a regression")
+    args = parser.parse_args()
+
+    results = run(args.names, args.repeat)
+    data = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "unit": "us",
+        "results": results,
+    }
+
+    with open(args.baseline if args.save_baseline else args.output, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+    baseline = {}
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    if report(results, baseline, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
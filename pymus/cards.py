@@ -1,146 +1,285 @@
+import array
+import hashlib
+import itertools
 import random
 
 class Card:
+    """Immutable card. The 40 instances are created once and shared by every deal."""
+
+    __slots__ = ("_index", "value", "color")
+
     COLORS = ["Copas", "Espadas", "Bastos", "Oros"]
     VALUES = [1, 2, 3, 4, 5, 6, 7, 10, 11, 12]
+    DECK = []
 
-    def __init__(self, index=None, value=None, color=None):
-        if index is not None:
-            self.value = Card.VALUES[int(index / len(Card.COLORS))]
-            self.color = Card.COLORS[index % len(Card.COLORS)]
-        else:
+    def __new__(cls, index=None, value=None, color=None):
+        if index is None and value is None and color is None:
+            # Games pickled before cards were interned are rebuilt through __setstate__
+            return object.__new__(cls)
+        if index is None:
             if value not in Card.VALUES or color not in Card.COLORS:
                 raise ForbiddenActionException
-            self.value = value
-            self.color = color
+            index = Card.COLORS.index(color) + len(Card.COLORS) * Card.VALUES.index(value)
+        return Card.DECK[index]
+
+    def __init__(self, index=None, value=None, color=None):
+        # Unpickling never calls __init__, so only a blank card left by a call without arguments gets here
+        if not hasattr(self, "_index"):
+            raise TypeError("Card needs an index, or a value and a color")
+
+    @classmethod
+    def _create(cls, index):
+        card = object.__new__(cls)
+        object.__setattr__(card, "_index", index)
+        object.__setattr__(card, "value", Card.VALUES[index // len(Card.COLORS)])
+        object.__setattr__(card, "color", Card.COLORS[index % len(Card.COLORS)])
+        return card
 
     def index(self):
-        return Card.COLORS.index(self.color) + len(Card.COLORS) * Card.VALUES.index(self.value)
+        return self._index
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Card is immutable")
+
+    def __reduce__(self):
+        return Card, (self._index,)
+
+    def __setstate__(self, state):
+        object.__setattr__(self, "value", state["value"])
+        object.__setattr__(self, "color", state["color"])
+        object.__setattr__(self, "_index",
+                           Card.COLORS.index(state["color"]) + len(Card.COLORS) * Card.VALUES.index(state["value"]))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
 
     def __str__(self):
         return str(self.value) + ' - ' + self.color
 
     def __eq__(self, card):
-        return self.index() == card.index()
+        return self._index == card.index()
+
+    def __hash__(self):
+        return self._index
 
     def __lt__(self, card):
-        return self.index() < card.index()
+        return self._index < card.index()
+
+
+Card.DECK.extend(Card._create(i) for i in range(len(Card.COLORS) * len(Card.VALUES)))
+
+
+class LanceTable:
+    """Rank and bonus of every 4-card value multiset for one lance.
+
+    Suits never matter, so the 715 sorted value tuples cover every possible hand.
+    Ranks are dense integers: a higher rank always beats a lower one."""
+
+    def __init__(self, hand_type):
+        keys = list(itertools.combinations_with_replacement(Card.VALUES, 4))
+        strengths = {key: hand_type.strength(key) for key in keys}
+        rank_of = {strength: rank for rank, strength in enumerate(sorted(set(strengths.values())))}
+
+        self.ranks = {key: rank_of[strengths[key]] for key in keys}
+        self.bonuses = {key: hand_type.value_bonus(key) for key in keys}
+
+    def __len__(self):
+        return len(self.ranks)
+
+
+def hand_values(cards):
+    return tuple(sorted(card.value for card in cards))
 
 
 class Hand:
+    table = None
+
     def __init__(self, cards):
         self.hand = cards
+        self.values = hand_values(cards)
 
+    @staticmethod
+    def strength(values):
+        raise NotImplementedError
 
-class HaundiaHand(Hand):
-    def __lt__(self, other):
-        return (sorted([c.value for c in self.hand], reverse=True)
-                < sorted([c.value for c in other.hand], reverse=True))
+    @staticmethod
+    def value_bonus(values):
+        return 0
 
+    def rank(self):
+        return self.table.ranks[self.values]
 
-class TipiaHand(Hand):
-    def __lt__(self, other):
-        return sorted([c.value for c in self.hand]) > sorted([c.value for c in other.hand])
+    def bonus(self):
+        return self.table.bonuses[self.values]
 
+    def __lt__(self, other):
+        return self.rank() < other.rank()
 
-class PariakHand(Hand):
-    def has_hand(self):
-        values = [card.value for card in self.hand]
-        counter = [values.count(value) for value in set(values)]
-        return any(count >= 2 for count in counter)
 
-    def group_pairs(self):
-        values = [card.value for card in self.hand]
-        return sorted(((values.count(value), value) for value in sorted(list(set(values)), reverse=True)), reverse=True)
+class HaundiaHand(Hand):
+    @staticmethod
+    def strength(values):
+        return tuple(sorted(values, reverse=True))
 
-    def has_double_pair(self):
-        return all(pair[0] == 2 for pair in self.group_pairs()) or self.group_pairs()[0][0] == 4
 
-    def has_triple(self):
-        return any(pair[0] == 3 for pair in self.group_pairs())
+class TipiaHand(Hand):
+    @staticmethod
+    def strength(values):
+        return tuple(-value for value in sorted(values))
 
-    def has_double_only(self):
-        return not self.has_double_pair() and any(pair[0] == 2 for pair in self.group_pairs())
 
-    def bonus(self):
-        if self.has_double_pair():
+class PariakHand(Hand):
+    @staticmethod
+    def group_values(values):
+        return tuple(sorted(((values.count(value), value) for value in set(values)), reverse=True))
+
+    @staticmethod
+    def value_bonus(values):
+        groups = PariakHand.group_values(values)
+        if all(count == 2 for count, _ in groups) or groups[0][0] == 4:
             return 3
-        if self.has_triple():
+        if groups[0][0] == 3:
             return 2
-        if self.has_double_only():
+        if groups[0][0] == 2:
             return 1
         return 0
 
-    def __lt__(self, other):
-        self_bonus, other_bonus = self.bonus(), other.bonus()
-        if self_bonus != other_bonus:
-            return self_bonus < other_bonus
+    @staticmethod
+    def strength(values):
+        return PariakHand.value_bonus(values), PariakHand.group_values(values)
 
-        own_group, other_group = self.group_pairs(), other.group_pairs()
-        return own_group < other_group
+    def group_pairs(self):
+        return PariakHand.group_values(self.values)
+
+    def has_hand(self):
+        return self.bonus() > 0
 
 
 class JokuaHand(Hand):
     jokua_index = {(33 + i): i for i in range(8)}
     jokua_index.update({32: 8, 31: 9})
 
-    def sum_cards(self):
-        return sum(min(card.value, 10) for card in self.hand)
-
-    def has_game(self):
-        return self.sum_cards() > 30
+    @staticmethod
+    def sum_values(values):
+        return sum(min(value, 10) for value in values)
 
-    def bonus(self):
-        card_sum = self.sum_cards()
+    @staticmethod
+    def value_bonus(values):
+        card_sum = JokuaHand.sum_values(values)
         if card_sum > 31:
             return 2
         if card_sum == 31:
             return 3
         return 0
 
-    def __lt__(self, other):
-        if self.has_game():
-            if not other.has_game():
-                return False
-            return JokuaHand.jokua_index[self.sum_cards()] < JokuaHand.jokua_index[other.sum_cards()]
+    @staticmethod
+    def strength(values):
+        card_sum = JokuaHand.sum_values(values)
+        if card_sum > 30:
+            return 1, JokuaHand.jokua_index[card_sum]
+        return 0, card_sum
+
+    def sum_cards(self):
+        return JokuaHand.sum_values(self.values)
+
+    def has_game(self):
+        return self.bonus() > 0
 
-        return self.sum_cards() < other.sum_cards()
+
+HaundiaHand.table = LanceTable(HaundiaHand)
+TipiaHand.table = LanceTable(TipiaHand)
+PariakHand.table = LanceTable(PariakHand)
+JokuaHand.table = LanceTable(JokuaHand)
 
 
 class Packet:
-    CARDS = [Card(i) for i in range(len(Card.COLORS) * len(Card.VALUES))]
+    """The deck as a ring of 40 card indices.
+
+    From `cursor` come the unused cards, then the used ones waiting to be reshuffled
+    into the next packet. Every packet owns its random stream: shuffle number n is
+    drawn from `seed` and n only, so a packet can be replayed from its seed."""
 
-    def __init__(self):
-        self.used_cards = []
-        self.unused_cards = []
+    CARDS = Card.DECK
+
+    def __init__(self, seed=None):
+        self.seed = random.getrandbits(64) if seed is None else seed
+        self.shuffles = 0
+        self.cards = array.array('b', range(len(Packet.CARDS)))
+        self.cursor = 0
+        self.n_unused = 0
+        self.n_used = 0
         self.restore()
 
+    @classmethod
+    def from_state(cls, seed, shuffles, cards, cursor, n_unused, n_used):
+        """Rebuilds a packet as it was saved, without shuffling a new one."""
+        packet = cls.__new__(cls)
+        packet.seed = seed
+        packet.shuffles = shuffles
+        packet.cards = array.array('b', cards)
+        packet.cursor = cursor
+        packet.n_unused = n_unused
+        packet.n_used = n_used
+        return packet
+
+    @property
+    def unused_cards(self):
+        return [self.cards[(self.cursor + i) % len(self.cards)] for i in range(self.n_unused)]
+
+    @property
+    def used_cards(self):
+        start = (self.cursor + self.n_unused) % len(self.cards)
+        end = start + self.n_used
+        if end <= len(self.cards):
+            return self.cards[start:end].tolist()
+        return self.cards[start:].tolist() + self.cards[:end - len(self.cards)].tolist()
+
     def restore(self):
-        self.unused_cards = []
-        self.used_cards = list(range(len(Packet.CARDS)))
+        self.cards = array.array('b', range(len(Packet.CARDS)))
+        self.cursor = 0
+        self.n_unused = 0
+        self.n_used = len(self.cards)
         self.new_packet()
 
     def new_packet(self):
-        self.unused_cards = self.used_cards
-        random.shuffle(self.unused_cards)
-        self.used_cards = []
+        used = self.used_cards
+        # Sorting the cards by keys hashed from (seed, shuffles) costs less than seeding a Random per shuffle
+        keys = hashlib.shake_128(b"%d:%d" % (self.seed, self.shuffles)).digest(4 * len(used))
+        used.sort(key=dict(zip(used, array.array('I', keys))).__getitem__)
+        self.shuffles += 1
+        self.cards[0:len(used)] = array.array('b', used)
+        self.cursor = 0
+        self.n_unused = len(used)
+        self.n_used = 0
+
+    def draw(self, n):
+        taken = [Packet.CARDS[self.cards[(self.cursor + i) % len(self.cards)]] for i in range(n)]
+        self.cursor = (self.cursor + n) % len(self.cards)
+        self.n_unused -= n
+        return taken
 
     def take(self, n):
-        delta = len(self.unused_cards) - n
-        if delta > 0:
-            taken = self.unused_cards[0: n]
-            self.unused_cards = self.unused_cards[n:]
-            return [Card(index) for index in taken]
-        else:
-            taken = self.unused_cards
-            self.new_packet()
-            taken += self.unused_cards[0:-delta]
-            self.unused_cards = self.unused_cards[-delta:]
-            return [Card(index) for index in taken]
+        if n < self.n_unused:
+            return self.draw(n)
+        taken = self.draw(self.n_unused)
+        self.new_packet()
+        return taken + self.draw(min(n - len(taken), self.n_unused))
 
     def trade(self, card):
-        self.used_cards.append(card.index())
+        self.cards[(self.cursor + self.n_unused + self.n_used) % len(self.cards)] = card.index()
+        self.n_used += 1
         return self.take(1)
 
-
-
+    def __setstate__(self, state):
+        if "unused_cards" in state:
+            # Packets pickled before the ring layout hold two lists of indices
+            unused, used = state.pop("unused_cards"), state.pop("used_cards")
+            cards = unused + used + [0] * (len(Packet.CARDS) - len(unused) - len(used))
+            # Seeded from the cards, so that every load of the same pickle deals the same next packets
+            seed = int.from_bytes(hashlib.blake2b(bytes(unused + [255] + used), digest_size=8).digest(), "big")
+            state.update(seed=seed, shuffles=0, cards=array.array('b', cards),
+                         cursor=0, n_unused=len(unused), n_used=len(used))
+        self.__dict__.update(state)
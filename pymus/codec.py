@@ -0,0 +1,313 @@
+""" Compact binary encoding of a mus.Game.
+
+Unlike pickle, the format only depends on the game rules, not on the class layout:
+decoding goes through the public constructors. Only the states that can still be
+read are written: the current one and the four lances, which keep their outcome
+until the next hand reaches them. Seats, cards and actions are single bytes.
+Every encoding starts with MAGIC and VERSION."""
+
+import struct
+
+from collections import namedtuple
+
+import mus
+
+
+MAGIC = b"MUS"
+VERSION = 1
+
+STATES = ["waiting_room", "Speaking", "Trading", "Haundia", "Tipia", "Pariak", "Jokua", "Finished"]
+ACTIONS = ["add_player", "remove_player", "start", "mus", "mintza", "change", "confirm",
+           "paso", "imido", "tira", "gehiago", "hordago", "kanta", "idoki", "ok"]
+ACTION_CODES = {action: code for code, action in enumerate(ACTIONS)}
+
+NONE = 255
+CARDS = mus.Packet.CARDS
+
+HEADER = struct.Struct(">3sBBB")                           # magic, version, finished, current state
+TABLE = struct.Struct(">QIBBB{}shhBhhBBBBB".format(len(mus.Packet.CARDS)))
+# packet: seed, shuffles, cursor, unused, used, cards; both teams: score, begin score, said mus;
+# players, authorised mask, authorised player seat, authorised team
+PLAYER = struct.Struct(">BBBBB")                           # team, seat, flags, asks, number of cards
+LANCE = struct.Struct(">hhhBBBB4sH")
+# bet, bonus, proposal, flags, winner, first player seat, ranked, ranking seats, history length
+COUNT = struct.Struct(">H")
+ENTRY = struct.Struct(">BBB")                              # player position, action, number of arguments
+INTEGER = struct.Struct(">Bq")
+EVENT = struct.Struct(">BBI")                              # action, number of arguments, shuffles after it
+
+Event = namedtuple("Event", ["player_id", "action", "args", "shuffles"])
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def is_encoded(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+def flags(*values):
+    value = 0
+    for i, flag in enumerate(values):
+        if flag:
+            value |= 1 << i
+    return value
+
+
+def seat_of(player):
+    return player.index if isinstance(player, mus.Player) else NONE
+
+
+def write_text(out, text):
+    data = text.encode("utf-8")
+    out += COUNT.pack(len(data))
+    out += data
+
+
+def write_value(out, value):
+    if value is None:
+        out.append(0)
+    elif isinstance(value, int):
+        out += INTEGER.pack(1, value)
+    else:
+        out.append(2)
+        write_text(out, str(value))
+
+
+def write_history(out, history, positions):
+    """Writes the fixed size entries first, then the arguments and the ids of the players who left."""
+    extra = bytearray()
+    for player_id, action, *args in history:
+        position = positions.get(player_id, NONE)
+        out += ENTRY.pack(position, ACTION_CODES[action], len(args))
+        if position == NONE:
+            write_value(extra, player_id)
+        for arg in args:
+            write_value(extra, arg)
+    out += extra
+
+
+def encode(game):
+    manager = game.players
+    packet = game.packet
+    team_0, team_1 = manager.teams
+    players = manager.get_all()
+
+    out = bytearray(HEADER.pack(MAGIC, VERSION, game.finished, STATES.index(game.current)))
+    out += TABLE.pack(packet.seed, packet.shuffles, packet.cursor, packet.n_unused, packet.n_used,
+                      packet.cards.tobytes(),
+                      team_0.score, team_0.begin_score, team_0.said == "mus",
+                      team_1.score, team_1.begin_score, team_1.said == "mus",
+                      len(players), manager.authorised, seat_of(manager.authorised_player),
+                      NONE if manager.authorised_team is None else manager.authorised_team.number)
+    write_value(out, game.game_id)
+
+    for player in players:
+        write_value(out, player.id)
+        write_text(out, player.name)
+        out += PLAYER.pack(player.team.number, NONE if player.index is None else player.index,
+                           flags(player.has_game, player.has_hand, player.waiting_confirmation,
+                                 player.said == "confirm"),
+                           flags(*(ask in player.asks for ask in range(4))),
+                           len(player.cards))
+        out += bytes([card.index() for card in player.cards])
+
+    lances = [game.states[name] for name in mus.Game.bet_states]
+    for lance in lances:
+        out += LANCE.pack(lance.bet, lance.bonus, lance.proposal,
+                          flags(lance.deffered, lance.engaged, lance.hor_daged,
+                                getattr(lance, "no_bet", False), getattr(lance, "no_winner", False),
+                                getattr(lance, "false_game", False)),
+                          NONE if lance.winner is None else lance.winner.number,
+                          seat_of(lance.first_player), len(lance.ranking),
+                          bytes([player.index for player in lance.ranking]), len(lance.history))
+
+    # History entries refer to the players above by position, unless they left the game since
+    positions = {player.id: position for position, player in enumerate(players)}
+    for lance in lances:
+        write_history(out, lance.history, positions)
+    if game.current not in mus.Game.bet_states:
+        out += COUNT.pack(len(game.state.history))
+        write_history(out, game.state.history, positions)
+
+    return bytes(out)
+
+
+def read_text(data, offset):
+    """Returns the text at `offset` and the offset after it."""
+    length, = COUNT.unpack_from(data, offset)
+    offset += COUNT.size + length
+    if offset > len(data):
+        raise DecodeError("Truncated data")
+    return data[offset - length:offset].decode("utf-8"), offset
+
+
+def read_value(data, offset):
+    """Returns the value at `offset` and the offset after it."""
+    tag = data[offset]
+    if tag == 0:
+        return None, offset + 1
+    if tag == 1:
+        return INTEGER.unpack_from(data, offset)[1], offset + INTEGER.size
+    if tag == 2:
+        return read_text(data, offset + 1)
+    raise DecodeError("Unknown value tag {}".format(tag))
+
+
+def read_history(data, offset, length, player_ids):
+    """Returns the history of `length` entries at `offset` and the offset after it."""
+    history = []
+    end = offset + ENTRY.size * length
+    for position, action, n_args in ENTRY.iter_unpack(data[offset:end]):
+        if position != NONE and not n_args:
+            history.append((player_ids[position], ACTIONS[action]))
+            continue
+        if position == NONE:
+            player_id, end = read_value(data, end)
+        else:
+            player_id = player_ids[position]
+        entry = [player_id, ACTIONS[action]]
+        for _ in range(n_args):
+            arg, end = read_value(data, end)
+            entry.append(arg)
+        history.append(tuple(entry))
+    return history, end
+
+
+def checked(read, data):
+    """Calls `read` on `data`, any inconsistency in it raising a DecodeError."""
+    try:
+        return read(bytes(data))
+    except struct.error as error:
+        raise DecodeError(error)
+    except (IndexError, KeyError, UnicodeDecodeError) as error:
+        raise DecodeError("Inconsistent data: {!r}".format(error))
+
+
+def decode(data):
+    return checked(read_game, data)
+
+
+def read_game(data):
+    magic, version, finished, current = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise DecodeError("Not an encoded game")
+    if version != VERSION:
+        raise DecodeError("Unsupported version {}".format(version))
+
+    (seed, shuffles, cursor, n_unused, n_used, cards,
+     score_0, begin_score_0, said_0, score_1, begin_score_1, said_1,
+     n_players, authorised, authorised_player, authorised_team) = TABLE.unpack_from(data, HEADER.size)
+    game_id, offset = read_value(data, HEADER.size + TABLE.size)
+    game = mus.Game(game_id, packet=mus.Packet.from_state(seed, shuffles, cards, cursor, n_unused, n_used))
+    game.finished = bool(finished)
+    game.current = STATES[current]
+
+    manager = game.players
+    team_0, team_1 = teams = manager.teams
+    team_0.score, team_0.begin_score, team_0.said = score_0, begin_score_0, "mus" if said_0 else ""
+    team_1.score, team_1.begin_score, team_1.said = score_1, begin_score_1, "mus" if said_1 else ""
+
+    seats = [None] * n_players
+    for _ in range(n_players):
+        player_id, offset = read_value(data, offset)
+        name, offset = read_text(data, offset)
+        team, index, player_flags, asks, n_cards = PLAYER.unpack_from(data, offset)
+        offset += PLAYER.size + n_cards
+        player = mus.Player(player_id, name, manager)
+        player.team = teams[team]
+        player.team.players.append(player)
+        if index != NONE:
+            player.index = index
+            seats[index] = player
+        if player_flags:
+            player.has_game = bool(player_flags & 1)
+            player.has_hand = bool(player_flags & 2)
+            player.waiting_confirmation = bool(player_flags & 4)
+            player.said = "confirm" if player_flags & 8 else ""
+        if asks:
+            player.asks = {ask for ask in range(4) if asks >> ask & 1}
+        if n_cards:
+            player.cards = [CARDS[card] for card in data[offset - n_cards:offset]]
+    manager.index_players()
+    player_ids = [player.id for player in manager.all_players]
+
+    seats = tuple(player for player in seats if player is not None)
+    if seats:
+        manager.seats, manager.echku = seats, seats[0]
+        manager.team_masks = [sum(1 << player.index for player in team.players) for team in teams]
+    manager.authorised = authorised
+    manager.authorised_player = None if authorised_player == NONE else seats[authorised_player]
+    manager.authorised_team = None if authorised_team == NONE else teams[authorised_team]
+
+    lances = [game.states[name] for name in mus.Game.bet_states]
+    lengths = []
+    for lance in lances:
+        (lance.bet, lance.bonus, lance.proposal, lance_flags, winner, first_player, ranked, ranking,
+         length) = LANCE.unpack_from(data, offset)
+        offset += LANCE.size
+        lance.deffered = bool(lance_flags & 1)
+        lance.engaged = bool(lance_flags & 2)
+        lance.hor_daged = bool(lance_flags & 4)
+        if lance_flags >> 3:
+            for i, flag in enumerate(["no_bet", "no_winner", "false_game"], 3):
+                if hasattr(lance, flag):
+                    setattr(lance, flag, bool(lance_flags >> i & 1))
+        if winner != NONE:
+            lance.winner = teams[winner]
+        if first_player != NONE:
+            lance.first_player = seats[first_player]
+        if ranked:
+            lance.ranking = [seats[seat] for seat in ranking[:ranked]]
+        lengths.append(length)
+
+    for lance, length in zip(lances, lengths):
+        if length:
+            lance.history, offset = read_history(data, offset, length, player_ids)
+    if game.current not in mus.Game.bet_states:
+        length, = COUNT.unpack_from(data, offset)
+        game.state.history, offset = read_history(data, offset + COUNT.size, length, player_ids)
+    if offset > len(data):
+        raise DecodeError("Truncated data")
+
+    return game
+
+
+def encode_event(game, player_id, action, *args):
+    """Encodes an action accepted by `game`, with the number of packets shuffled so far.
+
+    Shuffle n of a packet only depends on its seed and n, so the counter is all a
+    replay needs to check that it dealt the same cards."""
+    out = bytearray(EVENT.pack(ACTION_CODES[action], len(args), game.packet.shuffles))
+    write_value(out, player_id)
+    for arg in args:
+        write_value(out, arg)
+    return bytes(out)
+
+
+def read_event(data):
+    action, n_args, shuffles = EVENT.unpack_from(data)
+    player_id, offset = read_value(data, EVENT.size)
+    args = []
+    for _ in range(n_args):
+        arg, offset = read_value(data, offset)
+        args.append(arg)
+    return Event(player_id, ACTIONS[action], args, shuffles)
+
+
+def decode_event(data):
+    return checked(read_event, data)
+
+
+def replay(game, events):
+    """Plays encoded events again on top of the snapshot `game`."""
+    for data in events:
+        event = decode_event(data)
+        try:
+            game.do(event.action, event.player_id, *event.args)
+        except mus.ForbiddenActionException:
+            raise DecodeError("Event {} cannot be replayed".format(event))
+        if game.packet.shuffles != event.shuffles:
+            raise DecodeError("Event {} dealt other cards".format(event))
+    return game
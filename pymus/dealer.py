@@ -0,0 +1,30 @@
+from collections import namedtuple
+
+import numpy as np
+
+from cards import Card
+import mus
+
+
+Deal = namedtuple("Deal", ["decks", "hands", "draws"])
+
+
+def shuffle_decks(k, rng=None):
+    """Returns a (k, 40) array whose rows are independent random orderings of the card indices."""
+    rng = np.random.default_rng(rng)
+    return rng.permuted(np.tile(np.arange(len(Card.DECK), dtype=np.int8), (k, 1)), axis=1)
+
+
+def deal(k, n_players, rng=None):
+    """Deals `k` tables of `n_players` (2 or 4) at once.
+
+    Cards are handed out like Packet.take: 4 at a time to each player in the order
+    the PlayerManager iterates over them (team 0, then team 1). `hands` is a
+    (k, n_players, 4) array of sorted card indices, like Player.cards after the deal,
+    and `draws` the (k, 40 - 4 * n_players) rest of each deck in the order the
+    Trading phase draws it."""
+    mus.check_table_size(n_players)
+    decks = shuffle_decks(k, rng)
+    dealt = 4 * n_players
+    hands = np.sort(decks[:, :dealt].reshape(k, n_players, 4), axis=-1)
+    return Deal(decks, hands, decks[:, dealt:])
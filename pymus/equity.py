@@ -0,0 +1,180 @@
+import functools
+import itertools
+import math
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from statistics import NormalDist
+
+import numpy as np
+
+from cards import Card
+import evaluator
+import mus
+
+
+LANCES = ["haundia", "tipia", "pariak", "jokua"]
+
+Estimate = namedtuple("Estimate", ["probability", "low", "high"])
+Equity = namedtuple("Equity", LANCES + ["samples"])
+
+
+def check_table(cards, n_players, seat):
+    if len(cards) != 4:
+        raise ValueError("A hand has 4 cards, got {}".format(len(cards)))
+    mus.check_table_size(n_players)
+    if not 0 <= seat < n_players:
+        raise ValueError("Seat {} is not at a {} players table".format(seat, n_players))
+
+
+def lance_wins(ranks, seat):
+    """Tells, for each simulated table, whether the team of `seat` wins each lance.
+
+    `ranks` holds (K, n_players) arrays in echku order: np.argmax picks the first
+    best hand, which is the echku tie-break of BetState.compute_winner.
+    Nobody wins Pariak when no player has pairs."""
+    n_players = ranks.haundia.shape[1]
+    own_team = np.arange(n_players) % 2 == seat % 2
+    rows = np.arange(ranks.haundia.shape[0])
+
+    wins = []
+    for lance in LANCES:
+        lance_ranks = getattr(ranks, lance)
+        winner = np.argmax(lance_ranks, axis=1)
+        won = own_team[winner]
+        if lance == "pariak":
+            won &= ranks.pariak_bonus[rows, winner] > 0
+        wins.append(won)
+    return wins
+
+
+def simulate(own, n_players, seat, samples, seed, batch_size=1 << 16):
+    """Deals `samples` random tables around the card indices `own` and counts the wins per lance."""
+    rng = np.random.default_rng(seed)
+    remaining = np.setdiff1d(np.arange(len(Card.DECK)), own)
+    others = [s for s in range(n_players) if s != seat]
+    wins = np.zeros(len(LANCES), dtype=np.int64)
+
+    done = 0
+    while done < samples:
+        size = min(batch_size, samples - done)
+        drawn = remaining[np.argsort(rng.random((size, len(remaining))), axis=1)[:, :4 * len(others)]]
+
+        hands = np.empty((size, n_players, 4), dtype=drawn.dtype)
+        hands[:, seat] = own
+        hands[:, others] = drawn.reshape(size, len(others), 4)
+
+        ranks = evaluator.evaluate(hands.reshape(-1, 4))
+        ranks = evaluator.HandRanks(*(rank.reshape(size, n_players) for rank in ranks))
+        wins += [won.sum() for won in lance_wins(ranks, seat)]
+        done += size
+
+    return wins
+
+
+def wilson_interval(successes, samples, confidence):
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    p = successes / samples
+    denominator = 1 + z * z / samples
+    center = (p + z * z / (2 * samples)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / samples + z * z / (4 * samples * samples)) / denominator
+    return Estimate(p, max(0., center - margin), min(1., center + margin))
+
+
+def monte_carlo_equity(cards, n_players, seat=0, samples=10000, confidence=0.95, seed=None, processes=None):
+    """Estimates the probability that the team of the player holding `cards` wins each lance.
+
+    `seat` is the position of the player in echku order (0 is the echku, who wins ties).
+    The remaining deck is dealt at random to the other players `samples` times.
+    With `processes`, samples are split across a process pool with independent RNG streams."""
+    check_table(cards, n_players, seat)
+    own = np.array([card.index() for card in cards])
+
+    if processes is None or processes <= 1:
+        wins = simulate(own, n_players, seat, samples, seed)
+    else:
+        seeds = np.random.SeedSequence(seed).spawn(processes)
+        chunks = [samples // processes + (i < samples % processes) for i in range(processes)]
+        with ProcessPoolExecutor(processes) as executor:
+            futures = [executor.submit(simulate, own, n_players, seat, chunk, chunk_seed)
+                       for chunk, chunk_seed in zip(chunks, seeds)]
+            wins = sum(future.result() for future in futures)
+
+    return Equity(*(wilson_interval(int(won), samples, confidence) for won in wins), samples=samples)
+
+
+MULTISETS = list(itertools.combinations_with_replacement(Card.VALUES, 4))
+MULTISET_INDEX = {values: i for i, values in enumerate(MULTISETS)}
+VALUE_COUNTS = np.array([[values.count(value) for value in Card.VALUES] for values in MULTISETS])
+MULTISET_RANKS = evaluator.evaluate_codes(np.array([evaluator.values_code(values) for values in MULTISETS]))
+BINOMIAL = np.array([[math.comb(n, k) for k in range(5)] for n in range(5)], dtype=np.float64)
+DEAL_FACTORS = np.stack([BINOMIAL[:, VALUE_COUNTS[:, value]] for value in range(len(Card.VALUES))])
+
+
+def deal_weights(remaining):
+    """Number of ways to draw each value multiset from the `remaining` cards per value.
+
+    `remaining` has shape (..., 10) and the result (..., 715). Weights stay below 2**53,
+    so float64 sums are exact and the products run through BLAS."""
+    remaining = np.clip(remaining, 0, len(Card.COLORS))
+    weights = DEAL_FACTORS[0][remaining[..., 0]]
+    for value in range(1, len(Card.VALUES)):
+        weights *= DEAL_FACTORS[value][remaining[..., value]]
+    return weights
+
+
+def best_of(rank_by_seat):
+    rank = max(rank_by_seat.values())
+    return rank, min(seat for seat, seat_rank in rank_by_seat.items() if seat_rank == rank)
+
+
+def losing(ranks, best_rank, best_seat, seat):
+    """Which hands at `seat` lose to `best_rank` held at `best_seat`, with the echku tie-break."""
+    return ranks < best_rank + (seat > best_seat)
+
+
+@functools.lru_cache(maxsize=None)
+def exact_wins(values, n_players, seat):
+    own = MULTISET_INDEX[values]
+    remaining = len(Card.COLORS) - VALUE_COUNTS[own]
+    opponents = [(seat + 1) % n_players, (seat + 3) % n_players] if n_players == 4 else [1 - seat]
+    wins = np.zeros(len(LANCES))
+
+    if n_players == 2:
+        weights = deal_weights(remaining)
+        for i, lance in enumerate(LANCES):
+            ranks = getattr(MULTISET_RANKS, lance)
+            if lance == "pariak" and MULTISET_RANKS.pariak_bonus[own] == 0:
+                continue
+            wins[i] = weights @ losing(ranks, ranks[own], seat, opponents[0])
+        return tuple(wins.tolist())
+
+    teammate = (seat + 2) % 4
+    teammate_weights = deal_weights(remaining)
+    for hand in np.flatnonzero(teammate_weights):
+        left = remaining - VALUE_COUNTS[hand]
+        first_weights = deal_weights(left)
+        first = np.flatnonzero(first_weights)
+        first_weights = first_weights[first] * teammate_weights[hand]
+        second_weights = deal_weights(left - VALUE_COUNTS[first])
+
+        for i, lance in enumerate(LANCES):
+            ranks = getattr(MULTISET_RANKS, lance)
+            best_rank, best_seat = best_of({seat: ranks[own], teammate: ranks[hand]})
+            if lance == "pariak" and max(MULTISET_RANKS.pariak_bonus[[own, hand]]) == 0:
+                continue
+            first_loses = losing(ranks[first], best_rank, best_seat, opponents[0])
+            second_loses = losing(ranks, best_rank, best_seat, opponents[1])
+            wins[i] += (first_weights * first_loses) @ (second_weights @ second_loses)
+    return tuple(wins.tolist())
+
+
+def exact_equity(cards, n_players, seat=0):
+    """Computes exactly the probability that the team of the player holding `cards` wins each lance.
+
+    Suits never matter, so the other hands are enumerated as value multisets weighted by
+    the number of deals that produce them. Results are cached per value multiset."""
+    check_table(cards, n_players, seat)
+    deals = math.prod(math.comb(len(Card.DECK) - 4 * (i + 1), 4) for i in range(n_players - 1))
+    wins = exact_wins(tuple(sorted(card.value for card in cards)), n_players, seat)
+    return Equity(*(Estimate(won / deals, won / deals, won / deals) for won in wins), samples=deals)
@@ -0,0 +1,63 @@
+from collections import namedtuple
+
+import numpy as np
+
+from cards import Card, HaundiaHand, TipiaHand, PariakHand, JokuaHand
+
+
+HandRanks = namedtuple("HandRanks", ["haundia", "tipia", "pariak", "jokua", "pariak_bonus", "jokua_bonus"])
+
+CODE_WEIGHTS = np.array([1000, 100, 10, 1], dtype=np.int32)
+CODE_SIZE = 10000
+
+
+def value_positions(indices):
+    """Maps card indices to the position of their value in Card.VALUES (0 to 9)."""
+    return np.asarray(indices) // len(Card.COLORS)
+
+
+def hand_codes(indices):
+    """Encodes each row of an (N, 4) array of card indices as the integer of its sorted value positions."""
+    positions = np.sort(value_positions(indices), axis=-1)
+    return positions.astype(np.int32) @ CODE_WEIGHTS
+
+
+def values_code(values):
+    return sum(Card.VALUES.index(value) * int(weight) for value, weight in zip(sorted(values), CODE_WEIGHTS))
+
+
+def _lookup(mapping):
+    table = np.full(CODE_SIZE, -1, dtype=np.int16)
+    for values, item in mapping.items():
+        table[values_code(values)] = item
+    return table
+
+
+HAUNDIA_RANKS = _lookup(HaundiaHand.table.ranks)
+TIPIA_RANKS = _lookup(TipiaHand.table.ranks)
+PARIAK_RANKS = _lookup(PariakHand.table.ranks)
+JOKUA_RANKS = _lookup(JokuaHand.table.ranks)
+PARIAK_BONUSES = _lookup(PariakHand.table.bonuses)
+JOKUA_BONUSES = _lookup(JokuaHand.table.bonuses)
+
+
+def evaluate_codes(codes):
+    return HandRanks(
+        haundia=HAUNDIA_RANKS[codes],
+        tipia=TIPIA_RANKS[codes],
+        pariak=PARIAK_RANKS[codes],
+        jokua=JOKUA_RANKS[codes],
+        pariak_bonus=PARIAK_BONUSES[codes],
+        jokua_bonus=JOKUA_BONUSES[codes],
+    )
+
+
+def evaluate(indices):
+    """Ranks an (N, 4) array of card indices for every lance in one call.
+
+    Ranks are the same integers as Hand.rank(): a higher rank beats a lower one.
+    A hand has pairs (resp. game) when its Pariak (resp. Jokua) bonus is positive."""
+    indices = np.asarray(indices)
+    if indices.shape[-1] != 4:
+        raise ValueError("Expected hands of 4 cards, got shape {}".format(indices.shape))
+    return evaluate_codes(hand_codes(indices))
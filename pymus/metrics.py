@@ -0,0 +1,139 @@
+""" Counters and latency histograms of the bot, served in the Prometheus text format.
+
+Recording a value takes a lock and, for histograms, a bisect over the bucket bounds:
+about a microsecond, next to the milliseconds a click spends waiting for Telegram.
+Label values are given in the order of the labels the metric was declared with."""
+
+import bisect
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+REGISTRY = []
+
+# Seconds, from the 100us of a cached game to the seconds of a slow Telegram call
+BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, escape(value)) for name, value in zip(names, values)) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        REGISTRY.append(self)
+
+    def samples(self):
+        """Yields the (suffix, label names, label values, value) of every sample."""
+        raise NotImplementedError
+
+    def expose(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.kind)]
+        with self.lock:
+            samples = list(self.samples())
+        for suffix, names, values, value in samples:
+            lines.append("{}{}{} {}".format(self.name, suffix, format_labels(names, values), value))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        return self.values.get(label_values, 0)
+
+    def samples(self):
+        for label_values, value in sorted(self.values.items()):
+            yield "", self.labels, label_values, value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                # One count per bucket, the +Inf one, then the sum
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.]
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, *label_values):
+        counts = self.values.get(label_values)
+        return 0 if counts is None else sum(counts[:-1])
+
+    def samples(self):
+        names = self.labels + ("le",)
+        for label_values, counts in sorted(self.values.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                yield "_bucket", names, label_values + (bound,), total
+            yield "_sum", self.labels, label_values, counts[-1]
+            yield "_count", self.labels, label_values, total
+
+
+def expose():
+    return "\n".join(metric.expose() for metric in REGISTRY) + "\n"
+
+
+STORAGE = Histogram("hordago_storage_seconds", "Storage loads and stores of HordagoDatabase.", ["operation"])
+ACTIONS = Histogram("hordago_action_seconds", "Game.do on a click, per action.", ["action"])
+TRANSITIONS = Histogram("hordago_transition_seconds", "Game.do on a click that changed the state.",
+                        ["source", "target"])
+RENDERS = Histogram("hordago_render_seconds", "Rendering of the game message and keyboard.", ["part"])
+TELEGRAM = Histogram("hordago_telegram_seconds", "Telegram Bot API calls, per method.", ["method"])
+TELEGRAM_ERRORS = Counter("hordago_telegram_errors_total", "Telegram Bot API calls that failed.", ["method"])
+CALLBACKS = Histogram("hordago_callback_seconds", "Handling of a callback query, from loading to answering.")
+CONFLICTS = Counter("hordago_conflicts_total", "Clicks played again because another worker saved the game first.")
+EDITS = Counter("hordago_edits_total", "Message edits, by outcome: sent, unchanged (same render as displayed), "
+                "superseded (replaced by a later one while pending) or reverted (back to the displayed render).",
+                ["outcome"])
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = expose().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host="127.0.0.1"):
+    """Serves the metrics on http://host:port/metrics from a background thread, and returns the server."""
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -12,19 +12,29 @@ class TeamWonException(Exception):
     pass
 
 
+def check_table_size(n_players):
+    if n_players not in (2, 4):
+        raise ValueError("A table has 2 or 4 players, got {}".format(n_players))
+
+
 class Player:
-    def __init__(self, player_id, player_name):
+    def __init__(self, player_id, player_name, manager=None):
         self.id = player_id
         self.name = player_name
 
+        self.manager = manager
         self.team = None
         self.index = None
-        self.is_authorised = False
         self.said = ""
         self.cards = []
         self.asks = set()
         self.has_game = False
         self.has_hand = False
+        self.waiting_confirmation = False
+
+    @property
+    def is_authorised(self):
+        return self.index is not None and bool(self.manager.authorised >> self.index & 1)
 
     def get_cards(self):
         return self.cards
@@ -45,6 +55,31 @@ class PlayerManager:
         self.echku = 0
         self.authorised_team = None
         self.authorised_player = None
+        self.by_id = {}
+        self.all_players = ()
+        self.seats = ()
+        self.authorised = 0
+        self.team_masks = [0, 0]
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "by_id" not in state:
+            # Games pickled before the indexes existed
+            self.index_players()
+            self.seats = tuple(sorted(self.all_players, key=lambda player: player.index)) if self.echku else ()
+        if "authorised" not in state:
+            # Games pickled when authorisation was a flag on each player, who may not be seated yet
+            authorised = [player for player in self.all_players
+                          if player.__dict__.pop("is_authorised", False) and player.index is not None]
+            for player in self.all_players:
+                player.manager = self
+            self.team_masks = [self.seat_mask(player for player in team.players if player.index is not None)
+                               for team in self.teams]
+            self.authorised = self.seat_mask(authorised)
+
+    def index_players(self):
+        self.all_players = tuple(player for team in self.teams for player in team.players)
+        self.by_id = {player.id: player for player in self.all_players}
 
     def has_finished(self):
         return any(team.score >= Game.score_max for team in self.teams)
@@ -58,33 +93,41 @@ class PlayerManager:
         if player_id in self:
             player = self[player_id]
             player.team.remove_player(player)
-        self.get_team(team_number).add_player(Player(player_id, player_name))
+        self.get_team(team_number).add_player(Player(player_id, player_name, self))
+        self.index_players()
 
     def remove(self, player_id):
         if player_id in self:
             player = self[player_id]
             player.team.remove_player(player)
+            self.index_players()
 
+    # Both are tuples, replaced rather than mutated whenever a player joins, leaves or moves
     def get_all(self):
-        return [player for team in self.teams for player in team.players]
+        return self.all_players
 
     def get_all_echku_sorted(self):
-        return sorted(self.get_all(), key=lambda player: player.index)
+        return self.seats
 
     def get_team(self, team_number):
         return self.teams[team_number]
 
+    @staticmethod
+    def seat_mask(players):
+        return sum(1 << player.index for player in players)
+
+    def is_authorised(self, player_id):
+        return player_id in self.by_id and self.by_id[player_id].is_authorised
+
+    def authorise_player(self, player):
+        self.authorised_player = player
+        self.authorised = 1 << player.index
+
     def authorise_echku_player(self):
-        players = self.get_all_echku_sorted()
-        self.authorised_player = players[0]
-        for player in players:
-            player.is_authorised = player == self.authorised_player
+        self.authorise_player(self.seats[0])
 
     def authorise_next_player(self):
-        players = self.get_all_echku_sorted()
-        self.authorised_player = players[(self.authorised_player.index + 1) % len(players)]
-        for player in players:
-            player.is_authorised = player == self.authorised_player
+        self.authorise_player(self.seats[(self.authorised_player.index + 1) % len(self.seats)])
 
     def other_team(self, team):
         if team.number == 0:
@@ -93,13 +136,13 @@ class PlayerManager:
 
     def authorise_team(self, team):
         self.authorised_team = team
-        team.authorise(True)
-        self.other_team(team).authorise(False)
+        self.authorised = self.team_masks[team.number]
 
     def authorise_echku_team(self):
-        team = self.get_all_echku_sorted()[0].team
-        team.authorise(True)
-        self.other_team(team).authorise(False)
+        self.authorised = self.team_masks[self.seats[0].team.number]
+
+    def toggle_authorisation(self):
+        self.authorised ^= self.seat_mask(self.seats)
 
     def record_scores(self):
         for team in self.teams:
@@ -109,31 +152,30 @@ class PlayerManager:
         team_0_size = len(self.get_team(0))
         return team_0_size == len(self.get_team(1)) and (team_0_size == 1 or team_0_size == 2)
 
+    def seat(self, players):
+        self.seats = tuple(players)
+        for index, player in enumerate(players):
+            player.index = index
+        self.team_masks = [self.seat_mask(team.players) for team in self.teams]
+        self.echku = players[0]
+
     def set_initial_echku(self):
-        index = 0
-        for i in range(len(self.teams[0])):
-            for team in self.teams:
-                team.players[i].index = index
-                index = index + 1
-        self.echku = self.get_all_echku_sorted()[0]
+        self.seat([team.players[i] for i in range(len(self.teams[0])) for team in self.teams])
 
     def set_echku(self):
-        players = self.get_all_echku_sorted()
-        for player in players:
-            player.index = (player.index - 1) % len(players)
-        self.echku = self.get_all_echku_sorted()[0]
+        self.seat(self.seats[1:] + self.seats[:1])
 
     def __iter__(self):
-        return iter(self.get_all())
+        return iter(self.all_players)
 
     def __contains__(self, player_id):
-        return player_id in [player.id for player in self.get_all()]
+        return player_id in self.by_id
 
     def __getitem__(self, player_id):
-        for other in self.get_all():
-            if player_id == other.id:
-                return other
-        raise IndexError
+        try:
+            return self.by_id[player_id]
+        except KeyError:
+            raise IndexError
 
 class Team:
     def __init__(self, number):
@@ -163,14 +205,6 @@ class Team:
             player.team = None
             self.players.remove(player)
 
-    def authorise(self, yes_or_no):
-        for player in self.players:
-            player.is_authorised = yes_or_no
-
-    def toggle_authorisation(self):
-        for player in self.players:
-            player.is_authorised = not player.is_authorised
-
     def __iter__(self):
         return iter(self.players)
 
@@ -195,7 +229,7 @@ class GameState:
         return [p.id for p in self.players.get_all() if p.is_authorised]
 
     def is_player_authorised(self, player_id):
-        return player_id in self.players_authorised()
+        return self.players.is_authorised(player_id)
 
     def authorise_next_player(self):
         self.players.authorise_next_player()
@@ -348,18 +382,20 @@ class BetState(GameState):
         self.hor_daged = False
         self.proposal = 0
         self.winner = None
+        self.ranking = []
+        self.first_player = None
+
+    def compute_ranking(self):
+        """Orders players from best to worst hand. The sort is stable, so ties keep echku order."""
+        self.ranking = sorted(self.players.get_all_echku_sorted(),
+                              key=lambda player: self.HandType(player.cards).rank(),
+                              reverse=True)
+        return self.ranking
 
     def compute_winner(self):
         if not self.deffered:
             return
-        echku_order = self.players.get_all_echku_sorted()
-        for i in range(len(echku_order)):
-            for j in range(i, len(echku_order)):
-                hand_1 = self.HandType(echku_order[i].cards)
-                hand_2 = self.HandType(echku_order[j].cards)
-                if hand_1 < hand_2:
-                    echku_order[i], echku_order[j] = echku_order[j], echku_order[i]
-        self.winner = echku_order[0].team
+        self.winner = self.compute_ranking()[0].team
 
     def compute_bonus(self):
         if self.has_bonus and self.engaged:
@@ -384,6 +420,7 @@ class BetState(GameState):
         self.first_player = self.players.echku
         self.players.authorise_echku_player()
         self.winner = None
+        self.ranking = []
         self.bet = 1
         self.deffered = True
         self.engaged = False
@@ -549,6 +586,11 @@ class Jokua(BetState):
             return ['ok']
         return super().actions_authorised()
 
+    def authorise_next_player(self):
+        self.players.authorise_next_player()
+        while not self.false_game and not self.players.authorised_player.has_game:
+            self.players.authorise_next_player()
+
     def handle(self, action, player_id, *args):
         if action == 'ok':
             if not self.players[player_id].waiting_confirmation:
@@ -645,11 +687,11 @@ class Game:
     score_max = 40
     bet_states = ["Haundia", "Tipia", "Pariak", "Jokua"]
 
-    def __init__(self, game_id):
+    def __init__(self, game_id, seed=None, packet=None):
         self.finished = False
         self.game_id = game_id
         self.players = PlayerManager()
-        self.packet = Packet()
+        self.packet = Packet(seed) if packet is None else packet
         self.states = {
             "waiting_room": WaitingRoom(self.players, self.packet),
             "Speaking": Speaking(self.players, self.packet),
@@ -662,6 +704,15 @@ class Game:
         }
         self.current = "waiting_room"
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Games pickled before the constructors set these, the game is the last object unpickled
+        for player in self.players.get_all():
+            player.__dict__.setdefault("waiting_confirmation", False)
+        for name in Game.bet_states:
+            self.states[name].__dict__.setdefault("ranking", [])
+            self.states[name].__dict__.setdefault("first_player", None)
+
     @property
     def state(self):
         return self.states[self.current]
@@ -0,0 +1,98 @@
+""" Profiles the handler after a slow update, to see afterwards why clicks were slow.
+
+Every callback query and chosen inline result is timed. One slower than `threshold`
+arms the profiler: each of the next updates is then profiled with probability
+`sample_rate`, until `count` profiles were written to `directory`. Each profile,
+readable with pstats, comes with a JSON file naming its game, the state the handler
+found it in, the action and the slow update that armed the profiler. Arming again waits `cooldown` seconds,
+and only one update is profiled at a time, which bounds the overhead under load."""
+
+import cProfile
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+
+class SlowCallbackProfiler:
+    FLAVORS = ["callback_query", "chosen_inline_result"]
+
+    def __init__(self, handler, directory="profiles", threshold=1., count=3, sample_rate=1., cooldown=60.):
+        self.handler = handler
+        self.directory = directory
+        self.threshold = threshold
+        self.count = count
+        self.sample_rate = sample_rate
+        self.cooldown = cooldown
+        self.rng = random.Random()
+        self.lock = threading.Lock()
+        self.profiling = threading.Lock()
+        self.armed = 0
+        self.armed_at = None
+        self.trigger = None
+        self.written = 0
+
+        for flavor in self.FLAVORS:
+            setattr(handler, "on_" + flavor, self.wrap(flavor, getattr(handler, "on_" + flavor)))
+
+    def wrap(self, flavor, method):
+        def timed(msg):
+            profile = self.start_profile()
+            begin = time.perf_counter()
+            try:
+                return method(msg)
+            finally:
+                elapsed = time.perf_counter() - begin
+                state = getattr(self.handler.handling, "state", None)
+                if profile is not None:
+                    profile.disable()
+                    self.profiling.release()
+                    self.dump(profile, self.describe(flavor, msg, state, elapsed))
+                elif elapsed > self.threshold:
+                    self.arm(flavor, msg, state, elapsed)
+        return timed
+
+    def start_profile(self):
+        with self.lock:
+            if not self.armed or self.rng.random() >= self.sample_rate:
+                return None
+            if not self.profiling.acquire(blocking=False):
+                return None
+            self.armed -= 1
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is running in this process
+            self.profiling.release()
+            return None
+        return profile
+
+    def arm(self, flavor, msg, state, elapsed):
+        now = time.monotonic()
+        with self.lock:
+            if self.armed or (self.armed_at is not None and now - self.armed_at < self.cooldown):
+                return
+            self.armed, self.armed_at = self.count, now
+            self.trigger = update = self.describe(flavor, msg, state, elapsed)
+        logging.warning("Slow %s on game %s: %.3f s, profiling the next %d updates",
+                        flavor, update["game_id"], elapsed, self.count)
+
+    def describe(self, flavor, msg, state, elapsed):
+        action = msg.get("data") if flavor == "callback_query" else "new_game"
+        return {"flavor": flavor, "game_id": msg.get("inline_message_id"), "state": state, "action": action,
+                "seconds": elapsed}
+
+    def dump(self, profile, update):
+        with self.lock:
+            self.written += 1
+            name = "{}-{}-{}".format(time.strftime("%Y%m%d-%H%M%S"), self.written, update["flavor"])
+            trigger = self.trigger
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        profile.dump_stats(path + ".prof")
+        with open(path + ".json", "w") as f:
+            json.dump(dict(update, trigger=trigger), f, indent=2)
+        logging.warning("Wrote the profile of a %s on game %s to %s.prof", update["flavor"], update["game_id"], path)
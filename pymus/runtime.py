@@ -0,0 +1,108 @@
+""" Runs a HordagoTelegramHandler on asyncio instead of telepot's blocking MessageLoop.
+
+Updates are long-polled with telepot.aio. Updates of different games are handled
+concurrently, the updates of one game in the order they came, through a queue per
+inline_message_id. The handler, its storage and its edit scheduler are shared with
+the blocking MessageLoop and stay synchronous: each update runs in a thread pool, so
+a slow Telegram or storage call only holds up its own game."""
+
+import asyncio
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncRuntime:
+    FLAVORS = ["callback_query", "chosen_inline_result", "inline_query"]
+
+    def __init__(self, handler, workers=8, queue_size=32, idle_timeout=60., poll_timeout=30):
+        """`workers` updates are handled at once at most, and `queue_size` updates wait per game."""
+        self.handler = handler
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="hordago")
+        self.queue_size = queue_size
+        self.idle_timeout = idle_timeout
+        self.poll_timeout = poll_timeout
+        self.queues = {}
+        self.serving = set()
+        self.inline = set()
+
+    def route(self, update):
+        """Returns the flavor of an update, its message and the game it belongs to, None for inline queries."""
+        for flavor in self.FLAVORS:
+            if flavor in update:
+                msg = update[flavor]
+                return flavor, msg, msg.get("inline_message_id")
+        return None, None, None
+
+    def dispatch(self, update):
+        flavor, msg, game_id = self.route(update)
+        if flavor is None:
+            return
+        if game_id is None:
+            task = asyncio.ensure_future(self.handle(flavor, msg))
+            self.inline.add(task)
+            task.add_done_callback(self.inline.discard)
+            return
+
+        if game_id not in self.queues:
+            self.queues[game_id] = asyncio.Queue(self.queue_size)
+            task = asyncio.ensure_future(self.serve(game_id, self.queues[game_id]))
+            self.serving.add(task)
+            task.add_done_callback(self.serving.discard)
+        try:
+            self.queues[game_id].put_nowait((flavor, msg))
+        except asyncio.QueueFull:
+            logging.warning("Dropping a %s for game %s, %d updates are waiting", flavor, game_id, self.queue_size)
+
+    async def handle(self, flavor, msg):
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, getattr(self.handler, "on_" + flavor), msg)
+        except Exception:
+            logging.exception("Failed to handle a %s", flavor)
+
+    async def serve(self, game_id, queue):
+        """Handles the updates of one game in order, and stops after `idle_timeout` seconds without any."""
+        while True:
+            try:
+                flavor, msg = await asyncio.wait_for(queue.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    del self.queues[game_id]
+                    return
+                continue
+            await self.handle(flavor, msg)
+            queue.task_done()
+
+    async def drain(self):
+        """Waits until every update dispatched so far was handled."""
+        await asyncio.gather(*self.inline, *(queue.join() for queue in list(self.queues.values())))
+
+    async def poll(self, bot):
+        offset = None
+        while True:
+            try:
+                updates = await bot.getUpdates(offset=offset, timeout=self.poll_timeout, allowed_updates=self.FLAVORS)
+            except Exception:
+                logging.exception("Failed to get updates")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                offset = update["update_id"] + 1
+                self.dispatch(update)
+
+    async def run(self):
+        # telepot.aio binds its HTTP sessions to the event loop running when it is first imported
+        import telepot.aio
+        try:
+            await self.poll(telepot.aio.Bot(self.handler.bot._token, asyncio.get_running_loop()))
+        finally:
+            await self.drain()
+            for task in list(self.serving):
+                task.cancel()
+            self.executor.shutdown()
+            self.handler.close()
+            # Its own exit hook would only find the loop closed
+            await telepot.aio.api._close_pools()
+
+    def start(self):
+        asyncio.run(self.run())
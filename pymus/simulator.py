@@ -0,0 +1,183 @@
+import argparse
+import random
+import time
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import mus
+
+
+GameResult = namedtuple("GameResult", ["winner", "scores", "hands", "actions"])
+SimulationReport = namedtuple("SimulationReport", ["games", "wins", "stalled", "hands", "actions",
+                                                   "seconds", "games_per_second"])
+
+GEHIAGO = [1, 2, 3, 4, 5, 10]
+
+
+class Policy:
+    """Decides for one seat. The simulator plays every forced move ('ok', 'confirm') itself."""
+
+    def start(self, seed):
+        """Called before each game with a seed private to that game and seat."""
+
+    def speak(self, game, player):
+        """Returns "mus" or "mintza"."""
+        raise NotImplementedError
+
+    def trade(self, game, player):
+        """Returns the positions (1 to 4) of the cards to change, at least one."""
+        raise NotImplementedError
+
+    def bet(self, game, player, actions):
+        """Returns one of `actions` followed by its arguments, like the arguments of Game.do."""
+        raise NotImplementedError
+
+
+class RandomPolicy(Policy):
+    def __init__(self):
+        self.rng = random.Random()
+
+    def start(self, seed):
+        self.rng.seed(seed)
+
+    def speak(self, game, player):
+        return self.rng.choice(["mus", "mintza"])
+
+    def trade(self, game, player):
+        return self.rng.sample(range(1, 5), self.rng.randint(1, 4))
+
+    def bet(self, game, player, actions):
+        action = self.rng.choice(actions)
+        if action == "gehiago":
+            minimum = 1 if game.state.engaged else 2
+            return action, str(self.rng.choice([bet for bet in GEHIAGO if bet >= minimum]))
+        return (action,)
+
+
+class PassivePolicy(Policy):
+    """Never raises: mintza, paso when possible, otherwise accepts small bets and refuses hordago."""
+
+    def speak(self, game, player):
+        return "mintza"
+
+    def trade(self, game, player):
+        return [1]
+
+    def bet(self, game, player, actions):
+        for action in ("paso", "idoki", "tira"):
+            if action in actions:
+                return (action,)
+        return (actions[0],)
+
+
+def next_move(game, policies):
+    state = game.state
+    seats = game.players.get_all_echku_sorted()
+
+    if "ok" in state.actions_authorised():
+        player = next(player for player in seats if player.waiting_confirmation)
+        return player, ("ok",)
+
+    if game.current == "Trading":
+        player = next(player for player in seats if player.said != "confirm")
+        if player.asks:
+            return player, ("confirm",)
+        return player, ("change", *(str(position) for position in policies[player.id].trade(game, player)))
+
+    player = next(player for player in seats if state.is_player_authorised(player.id))
+    if game.current == "Speaking":
+        return player, (policies[player.id].speak(game, player),)
+    return player, tuple(policies[player.id].bet(game, player, state.actions_authorised()))
+
+
+def play_move(game, policies):
+    player, (action, *args) = next_move(game, policies)
+    if action == "change":
+        for position in args:
+            game.do(action, player.id, position)
+    else:
+        game.do(action, player.id, *args)
+
+
+def new_game(policies, seed=None):
+    """Seats `policies` at a started game whose deal and policy choices only depend on `seed`."""
+    rng = random.Random(seed)
+    game = mus.Game(0, rng.getrandbits(64))
+    for player_id, policy in enumerate(policies):
+        policy.start(rng.getrandbits(64))
+        game.do("add_player", player_id, "Player {}".format(player_id), str(player_id % 2))
+    game.do("start", 0)
+    return game
+
+
+def play(policies, seed=None, max_actions=5000):
+    """Plays a whole game, until a team reaches Game.score_max, between 2 or 4 policies.
+
+    Policy i sits at seat i and plays for team i % 2; seat 0 is the first echku."""
+    game = new_game(policies, seed)
+    hands = actions = 0
+    while not (game.current == "Finished" and game.players.has_finished()):
+        if actions >= max_actions:
+            return GameResult(None, [team.score for team in game.players.teams], hands, actions)
+        previous = game.current
+        play_move(game, policies)
+        actions += 1
+        hands += previous != "Finished" and game.current == "Finished"
+
+    return GameResult(game.players.winner_team(), [team.score for team in game.players.teams], hands, actions)
+
+
+def play_many(policies, seeds, max_actions=5000):
+    return [play(policies, seed, max_actions) for seed in seeds]
+
+
+def simulate(policies, games, seed=None, processes=None, max_actions=5000):
+    """Plays `games` games between `policies` and reports outcome statistics and throughput.
+
+    Every game gets its own seed drawn from `seed`, so results do not depend on `processes`."""
+    mus.check_table_size(len(policies))
+    rng = random.Random(seed)
+    seeds = [rng.getrandbits(64) for _ in range(games)]
+
+    begin = time.perf_counter()
+    if processes is None or processes <= 1:
+        results = play_many(policies, seeds, max_actions)
+    else:
+        with ProcessPoolExecutor(processes) as executor:
+            chunks = executor.map(play_many, [policies] * processes,
+                                  [seeds[i::processes] for i in range(processes)],
+                                  [max_actions] * processes)
+            results = [result for chunk in chunks for result in chunk]
+    seconds = time.perf_counter() - begin
+
+    return SimulationReport(
+        games=games,
+        wins=[sum(result.winner == team for result in results) for team in range(2)],
+        stalled=sum(result.winner is None for result in results),
+        hands=sum(result.hands for result in results),
+        actions=sum(result.actions for result in results),
+        seconds=seconds,
+        games_per_second=games / seconds if seconds else float("inf"),
+    )
+
+
+POLICIES = {"random": RandomPolicy, "passive": PassivePolicy}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("policies", nargs="+", choices=sorted(POLICIES),
+                        help="The policy of each seat, 2 or 4 of them")
+    parser.add_argument("-n", "--games", type=int, default=1000, help="Number of games to play")
+    parser.add_argument("-s", "--seed", type=int, help="Seed of the whole run")
+    parser.add_argument("-j", "--processes", type=int, help="Number of worker processes")
+    args = parser.parse_args()
+
+    report = simulate([POLICIES[name]() for name in args.policies], args.games, args.seed, args.processes)
+    for field, value in report._asdict().items():
+        print("{}: {}".format(field, value))
+
+
+if __name__ == "__main__":
+    main()
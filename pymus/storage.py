@@ -0,0 +1,271 @@
+""" Where HordagoDatabase keeps its bytes.
+
+A game is stored as a snapshot, the log of all its actions, the tail of that log
+written since the snapshot, the digest of its last render and a version, bumped by
+every store. Every backend loads and stores a game in a single step: one round trip
+for Redis, one transaction for SQLite. A store given the version its caller loaded
+fails with ConflictException if somebody else stored the game since."""
+
+import sqlite3
+import threading
+import time
+
+import redis
+
+
+class ConflictException(Exception):
+    pass
+
+
+class Storage:
+    def exists(self, game_id):
+        raise NotImplementedError
+
+    def load(self, game_id):
+        """Returns the snapshot (None without one), the list of events since, the render digest and the version."""
+        raise NotImplementedError
+
+    def store(self, game_id, snapshot=None, events=(), render=None, reset=False, version=None):
+        """Stores everything at once and returns the length of the tail and the new version.
+
+        `reset` first forgets the game. A `snapshot` replaces the previous one and empties the
+        tail. `events` are appended to the log, and to the tail when there is no `snapshot`.
+        With `version`, raises ConflictException unless the game is still at that version."""
+        raise NotImplementedError
+
+    def check(self, connections=1):
+        """Opens up to `connections` connections ahead of the first game, and raises if the storage cannot be used."""
+
+    def close(self):
+        pass
+
+
+class MemoryStorage(Storage):
+    """ Keeps everything in dicts, for tests and for running the bot without a server."""
+
+    def __init__(self):
+        self.snapshots = {}
+        self.logs = {}
+        self.tails = {}
+        self.renders = {}
+        self.versions = {}
+
+    def exists(self, game_id):
+        return game_id in self.snapshots
+
+    def load(self, game_id):
+        return (self.snapshots.get(game_id), list(self.tails.get(game_id, [])), self.renders.get(game_id),
+                self.versions.get(game_id, 0))
+
+    def store(self, game_id, snapshot=None, events=(), render=None, reset=False, version=None):
+        if version is not None and version != self.versions.get(game_id, 0):
+            raise ConflictException
+        if reset:
+            for values in (self.snapshots, self.logs, self.tails, self.renders, self.versions):
+                values.pop(game_id, None)
+        if render is not None:
+            self.renders[game_id] = render
+        if snapshot is not None:
+            self.snapshots[game_id] = snapshot
+            self.tails[game_id] = []
+        self.logs.setdefault(game_id, []).extend(events)
+        tail = self.tails.setdefault(game_id, [])
+        if snapshot is None:
+            tail.extend(events)
+        self.versions[game_id] = self.versions.get(game_id, 0) + 1
+        return len(tail), self.versions[game_id]
+
+
+class SQLiteStorage(Storage):
+    """ Keeps games in a SQLite file, in WAL mode.
+
+    Commits are batched: every `commit_every` stores, and at the latest `commit_interval`
+    seconds after a store, from a timer when no other store follows, and on close().
+    This connection sees its uncommitted writes, but a crash loses them. An uncommitted
+    store also keeps other processes from writing until then, so several processes
+    sharing the file want `commit_every` at 1. Threads share the connection, one at a time."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS games (
+            id PRIMARY KEY,
+            snapshot BLOB,
+            render BLOB,
+            logged INTEGER NOT NULL DEFAULT 0,
+            snapshot_at INTEGER NOT NULL DEFAULT 0,
+            version INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS log (
+            game_id NOT NULL,
+            position INTEGER NOT NULL,
+            event BLOB NOT NULL,
+            PRIMARY KEY (game_id, position)
+        );
+    """
+
+    def __init__(self, path, commit_every=32, commit_interval=1.):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(self.SCHEMA)
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.pending = 0
+        self.committed = time.monotonic()
+        self.timer = None
+
+    def exists(self, game_id):
+        with self.lock:
+            row = self.connection.execute("SELECT snapshot FROM games WHERE id = ?", (game_id,)).fetchone()
+        return row is not None and row[0] is not None
+
+    def load(self, game_id):
+        with self.lock:
+            return self.select(game_id)
+
+    def select(self, game_id):
+        row = self.connection.execute("SELECT snapshot, render, snapshot_at, version FROM games WHERE id = ?",
+                                      (game_id,)).fetchone()
+        if row is None:
+            return None, [], None, 0
+        snapshot, render, snapshot_at, version = row
+        events = [event for event, in self.connection.execute(
+            "SELECT event FROM log WHERE game_id = ? AND position >= ? ORDER BY position", (game_id, snapshot_at))]
+        return snapshot, events, render, version
+
+    def store(self, game_id, snapshot=None, events=(), render=None, reset=False, version=None):
+        with self.lock:
+            return self.update(game_id, snapshot, events, render, reset, version)
+
+    def update(self, game_id, snapshot, events, render, reset, version):
+        execute = self.connection.execute
+        if reset:
+            execute("DELETE FROM games WHERE id = ?", (game_id,))
+            execute("DELETE FROM log WHERE game_id = ?", (game_id,))
+        execute("INSERT OR IGNORE INTO games (id) VALUES (?)", (game_id,))
+
+        # The version check and the update are one statement, so that they happen under the write lock
+        updated = execute("UPDATE games SET snapshot = COALESCE(?, snapshot), render = COALESCE(?, render), "
+                          "snapshot_at = CASE WHEN ? IS NULL THEN snapshot_at ELSE logged + ? END, "
+                          "logged = logged + ?, version = version + 1 WHERE id = ? AND COALESCE(?, version) = version",
+                          (snapshot, render, snapshot, len(events), len(events), game_id, version))
+        if updated.rowcount == 0:
+            raise ConflictException
+        logged, snapshot_at, version = execute("SELECT logged, snapshot_at, version FROM games WHERE id = ?",
+                                               (game_id,)).fetchone()
+        first = logged - len(events)
+        self.connection.executemany("INSERT INTO log (game_id, position, event) VALUES (?, ?, ?)",
+                                    [(game_id, first + i, event) for i, event in enumerate(events)])
+
+        self.pending += 1
+        if self.pending >= self.commit_every or time.monotonic() - self.committed >= self.commit_interval:
+            self.commit()
+        elif self.timer is None:
+            self.timer = threading.Timer(self.commit_interval, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+        return logged - snapshot_at, version
+
+    def check(self, connections=1):
+        with self.lock:
+            self.connection.execute("SELECT id FROM games LIMIT 1").fetchall()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+        self.committed = time.monotonic()
+
+    def flush(self):
+        with self.lock:
+            self.timer = None
+            # Nothing is pending once closed
+            if self.pending:
+                self.commit()
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.commit()
+            self.connection.close()
+
+
+class RedisStorage(Storage):
+    """ Keeps games under "<game_id>", "<game_id>_log", "<game_id>_tail", "<game_id>_render"
+    and "<game_id>_version". Stores run as a Lua script, which Redis executes atomically."""
+
+    STORE = """
+        local game, log, tail, render, version = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5]
+        local reset, has_snapshot, snapshot, has_render, new_render, expected = unpack(ARGV, 1, 6)
+        if expected ~= "" and tonumber(redis.call("GET", version) or "0") ~= tonumber(expected) then
+            return false
+        end
+        if reset == "1" then
+            redis.call("DEL", game, log, tail, render, version)
+        end
+        if has_render == "1" then
+            redis.call("SET", render, new_render)
+        end
+        if has_snapshot == "1" then
+            redis.call("SET", game, snapshot)
+            redis.call("DEL", tail)
+        end
+        if #ARGV > 6 then
+            redis.call("RPUSH", log, unpack(ARGV, 7))
+            if has_snapshot ~= "1" then
+                redis.call("RPUSH", tail, unpack(ARGV, 7))
+            end
+        end
+        return {redis.call("LLEN", tail), redis.call("INCR", version)}
+    """
+
+    def __init__(self, host="localhost", port=6379, db=0, max_connections=None, **connection):
+        """Other keyword arguments go to the ConnectionPool, such as another `connection_class`."""
+        # With a maximum, threads wait for a free connection instead of failing
+        pool = redis.ConnectionPool if max_connections is None else redis.BlockingConnectionPool
+        self.pool = pool(host=host, port=port, db=db, max_connections=max_connections, **connection)
+        self.games = redis.StrictRedis(connection_pool=self.pool)
+        self.store_script = self.games.register_script(self.STORE)
+
+    @staticmethod
+    def keys(game_id):
+        return [game_id] + ["{}_{}".format(game_id, key) for key in ("log", "tail", "render", "version")]
+
+    def exists(self, game_id):
+        return self.games.exists(game_id) > 0
+
+    def load(self, game_id):
+        game, _, tail, render, version = self.keys(game_id)
+        with self.games.pipeline() as pipe:
+            pipe.get(game)
+            pipe.lrange(tail, 0, -1)
+            pipe.get(render)
+            pipe.get(version)
+            snapshot, events, render, version = pipe.execute()
+        return snapshot, events, render, int(version or 0)
+
+    def store(self, game_id, snapshot=None, events=(), render=None, reset=False, version=None):
+        arguments = [int(reset), int(snapshot is not None), snapshot or b"", int(render is not None), render or b"",
+                     "" if version is None else version]
+        stored = self.store_script(keys=self.keys(game_id), args=arguments + list(events))
+        if stored is None:
+            raise ConflictException
+        return tuple(stored)
+
+    def check(self, connections=1):
+        held = [self.pool.get_connection("PING") for _ in range(connections)]
+        try:
+            for connection in held:
+                connection.send_command("PING")
+                connection.read_response()
+        finally:
+            for connection in held:
+                self.pool.release(connection)
+        # Otherwise the first store finds the script missing and sends it again
+        self.games.script_load(self.STORE)
+
+    def close(self):
+        self.pool.disconnect()
+
+
+BACKENDS = {"memory": MemoryStorage, "sqlite": SQLiteStorage, "redis": RedisStorage}
@@ -1,82 +1,416 @@
 #! /usr/bin/env python3
 
+import collections
+import hashlib
+import itertools
+import json
+import logging
+import os
 import pickle
-import redis
 import sys
+import threading
+import time
 import yaml
 import telepot
 
 from telepot import namedtuple as tnp
 from telepot.loop import MessageLoop
 
+import codec
+import metrics
 import mus
 
+from storage import ConflictException, RedisStorage
+
+
+def render_digest(text, keyboard_key):
+    return hashlib.blake2b("{}\0{}".format(text, keyboard_key).encode("utf-8"), digest_size=16).digest()
+
+
+def jsonable(value):
+    """Converts telepot namedtuples to what they are sent as, without their None fields."""
+    if isinstance(value, list):
+        return [jsonable(item) for item in value]
+    if isinstance(value, tuple) and hasattr(value, "_asdict"):
+        return {name: jsonable(item) for name, item in value._asdict().items() if item is not None}
+    return value
+
+
+def to_json(value):
+    """Serializes a reply markup or inline results once, telepot sends strings as they are."""
+    return json.dumps(jsonable(value), separators=(",", ":"))
+
+
+INTERFACE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "static", "telegram_text_interface.yaml")
+
+
+def load_interface(path=INTERFACE):
+    """ Parses the texts and keyboards of the bot.
+
+    The result is pickled next to the file and read from there at the next start, as
+    long as the file keeps the same modification time and size."""
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cache = os.path.splitext(path)[0] + ".pickle"
+    try:
+        with open(cache, "rb") as f:
+            cached_stamp, data = pickle.load(f)
+        if cached_stamp == stamp:
+            return data
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        pass
+
+    with open(path) as f:
+        data = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+    try:
+        with open(cache + ".tmp", "wb") as f:
+            pickle.dump((stamp, data), f)
+        os.replace(cache + ".tmp", cache)
+    except OSError:
+        pass  # A read-only checkout parses the file every time
+    return data
+
+
+Stored = collections.namedtuple("Stored", ["game", "render", "version"])
+
+
+class TimedBot(telepot.Bot):
+    """ Records the duration of every Bot API call, they all go through _api_request."""
+
+    def _api_request(self, method, params=None, files=None, **kwargs):
+        begin = time.perf_counter()
+        try:
+            return super()._api_request(method, params, files, **kwargs)
+        except Exception:
+            metrics.TELEGRAM_ERRORS.inc(method)
+            raise
+        finally:
+            metrics.TELEGRAM.observe(time.perf_counter() - begin, method)
+
+
+class CachedGame:
+    def __init__(self, game, render=None, version=None):
+        self.game = game
+        self.render = render
+        self.version = version
+        self.used = time.monotonic()
+        self.dirty = False
+        self.events = []
+        self.hand_ended = False
+
 
 class HordagoDatabase():
-    def __init__(self):
-        self.games = redis.StrictRedis('localhost')
+    """ Stores games in a storage.Storage, Redis on localhost by default.
+
+    By default every save rewrites the whole game. With `snapshot_every`, accepted actions
+    are appended to a log instead, and the game itself is only written, as a snapshot,
+    every `snapshot_every` actions and at the end of each hand. The log is never trimmed,
+    its tail since the snapshot is replayed when loading the game. The digest of the
+    message last displayed for each game is stored alongside.
+
+    Loading and saving a game each take a single storage call, and a second one for the
+    saves that reach `snapshot_every`.
+
+    With `cache_size`, the last games used stay in memory, up to `max_idle` seconds, and
+    are only read from the storage when they are not there. This assumes a single process
+    serves the bot. A background thread drops the idle games, every `max_idle` / 2 seconds.
+    With `write_behind`, saves only mark the cached game dirty: it is written when evicted
+    and on close(), so a crash loses the clicks since. Evicted games are written outside
+    `lock`, in order, and loading one waits until it is written.
+
+    Saves given the version get() returned raise storage.ConflictException when another
+    worker saved the game in between, instead of silently overwriting its action. They
+    cannot be checked in write behind mode, which needs a single worker.
+
+    Several threads may use the database, as long as one game is only used by one
+    thread at a time: `lock` guards the cache."""
+
+    def __init__(self, storage=None, snapshot_every=None, cache_size=0, max_idle=600, write_behind=False):
+        self.storage = RedisStorage() if storage is None else storage
+        self.snapshot_every = snapshot_every
+        self.lock = threading.RLock()
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.max_idle = max_idle
+        self.write_behind = write_behind
+        # Games loaded from a pickle, which their next save replaces with a snapshot
+        self.pickled = set()
+        # Dirty games dropped from the cache, until write_back() stored them
+        self.evicted = []
+        self.written = threading.Condition(self.lock)
+        self.writing = threading.Lock()
+        self.closing = threading.Event()
+        if cache_size and max_idle is not None:
+            threading.Thread(target=self.sweep, name="idle-games", daemon=True).start()
 
     def has_game(self, game_id):
-        return self.games.get(game_id) is not None
+        return game_id in self.cache or self.storage.exists(game_id)
 
     def new_game(self, game_id):
         game = mus.Game(game_id)
-        self.games.set(game_id, pickle.dumps(game))
+        with self.lock:
+            self.cache.pop(game_id, None)
+            self.wait_written(game_id)
+        _, version = self.store(game_id, codec.encode(game), reset=True)
+        with self.lock:
+            self.cache_game(game, version=version)
+        self.write_back()
         return game
 
     def get(self, game_id):
-        game = self.games.get(game_id)
+        """Returns the game, the digest of its last render and its version, all None when it cannot be loaded."""
+        with self.lock:
+            if game_id in self.cache:
+                self.cache.move_to_end(game_id)
+                cached = self.cache[game_id]
+                cached.used = time.monotonic()
+                return Stored(cached.game, cached.render, cached.version)
+            self.wait_written(game_id)
+
+        begin = time.perf_counter()
+        data, events, render, version = self.storage.load(game_id)
+        metrics.STORAGE.observe(time.perf_counter() - begin, "load")
+        if self.snapshot_every is None:
+            events = []
+
+        game = self.decode(data, events)
+        if game is None:
+            return Stored(None, None, None)
+        with self.lock:
+            if not codec.is_encoded(data):
+                self.pickled.add(game_id)
+            self.cache_game(game, render, version)
+        self.write_back()
+        return Stored(game, render, version)
+
+    @staticmethod
+    def decode(data, events):
         try:
-            return pickle.loads(game)
-        except (pickle.PickleError, TypeError, AttributeError):
+            if codec.is_encoded(data):
+                return codec.replay(codec.decode(data), events)
+            # Games saved before the binary encoding, rewritten on their next save
+            return codec.replay(pickle.loads(data), events)
+        except (codec.DecodeError, pickle.PickleError, TypeError, AttributeError):
             return None
 
-    def save(self, game):
-        self.games.set(game.game_id, pickle.dumps(game))
-
-    def response_has_changed(self, game_id, text, keyboard):
-        old_text = self.games.get("{}_{}".format(game_id, "text"))
-        old_keyboard = self.games.get("{}_{}".format(game_id, "keyboard"))
-
-        text_changed = old_text is None or old_text.decode("utf-8") != text
-        keyboard_changed = old_keyboard is None or old_keyboard.decode("utf-8") != str(keyboard)
+    def cache_game(self, game, render=None, version=None):
+        if not self.cache_size:
+            return None
+        cached = self.cache.get(game.game_id)
+        if cached is None or cached.game is not game:
+            self.flush(game.game_id)
+            cached = self.cache[game.game_id] = CachedGame(game, render, version)
+        self.cache.move_to_end(game.game_id)
+        while len(self.cache) > self.cache_size:
+            self.flush(next(iter(self.cache)))
+        return cached
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self.lock:
+            while self.cache:
+                game_id, cached = next(iter(self.cache.items()))
+                if now - cached.used <= self.max_idle:
+                    break
+                self.flush(game_id)
+        self.write_back()
+
+    def sweep(self):
+        while not self.closing.wait(self.max_idle / 2):
+            try:
+                self.evict_idle()
+            except Exception:
+                logging.exception("Failed to write idle games")
+
+    def flush(self, game_id):
+        """Drops the game from the cache, to be written by write_back() if it is dirty. Needs `lock`."""
+        cached = self.cache.pop(game_id, None)
+        if cached is not None and cached.dirty:
+            self.evicted.append(cached)
+
+    def write_back(self):
+        """Writes the games flushed from the cache, without holding `lock`."""
+        if not self.evicted:
+            return
+        with self.writing:
+            while True:
+                with self.lock:
+                    if not self.evicted:
+                        return
+                    cached = self.evicted[0]
+                try:
+                    self.write(cached.game, cached.events, cached.hand_ended, cached.render)
+                finally:
+                    with self.lock:
+                        self.evicted.pop(0)
+                        self.written.notify_all()
+
+    def wait_written(self, game_id):
+        """Waits until a flushed version of the game is stored, so that loading it sees it. Needs `lock`."""
+        while any(cached.game.game_id == game_id for cached in self.evicted):
+            self.written.wait()
+
+    def close(self):
+        self.closing.set()
+        with self.lock:
+            for game_id in list(self.cache):
+                self.flush(game_id)
+        self.write_back()
+        self.storage.close()
+
+    def store(self, game_id, *args, **kwargs):
+        begin = time.perf_counter()
+        try:
+            return self.storage.store(game_id, *args, **kwargs)
+        finally:
+            metrics.STORAGE.observe(time.perf_counter() - begin, "store")
+
+    def write(self, game, events, hand_ended, render, version=None):
+        """Returns the new version of the game."""
+        if self.snapshot_every is None or hand_ended:
+            return self.store(game.game_id, codec.encode(game), events, render, version=version)[1]
+        tail, version = self.store(game.game_id, None, events, render, version=version)
+        if tail >= self.snapshot_every:
+            try:
+                version = self.store(game.game_id, codec.encode(game), version=version)[1]
+            except ConflictException:
+                pass  # The actions are logged, the next save will take the snapshot
+        return version
+
+    def save(self, game, event=None, render=None, version=None):
+        """Saves `game` after `event`, the (player_id, action, *args) it accepted, if any,
+        with `render`, the digest of the message now displayed."""
+        if self.snapshot_every is not None and event is None and render is None:
+            return
+        events = [] if event is None or self.snapshot_every is None else [codec.encode_event(game, *event)]
+        hand_ended = event is not None and game.current == "Finished" and not game.state.history
+
+        with self.lock:
+            # Events are not logged on top of a pickle, which may not load the same way twice
+            pickled = game.game_id in self.pickled
+            self.pickled.discard(game.game_id)
+            hand_ended |= pickled
+            cached = self.cache_game(game)
+            if cached is not None:
+                cached.render = cached.render if render is None else render
+                if self.write_behind:
+                    cached.dirty = True
+                    cached.events += events
+                    cached.hand_ended |= hand_ended
+        self.write_back()
+        if cached is not None and self.write_behind:
+            return
+        try:
+            version = self.write(game, events, hand_ended, render, version)
+        except ConflictException:
+            # The cached game holds an action the storage refused, it must be loaded again
+            with self.lock:
+                self.cache.pop(game.game_id, None)
+            raise
+        except Exception:
+            if pickled:
+                with self.lock:
+                    self.pickled.add(game.game_id)
+            raise
+        if cached is not None:
+            cached.version = version
+
+
+Edit = collections.namedtuple("Edit", ["shown", "digest", "text", "keyboard"])
+
+
+class EditScheduler:
+    """ Sends the edits of each message `delay` seconds after the first one, coalesced.
+
+    An edit scheduled while another edit of the same message is pending replaces it,
+    so a burst of clicks costs a single editMessageText, with the last render. It is
+    dropped if that render is the one displayed before the burst. The edits of a
+    message are sent one at a time, in order. Without a delay, edits are sent at once."""
+
+    def __init__(self, bot, delay=0.):
+        self.bot = bot
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.timers = {}
+        self.sending = set()
+
+    def schedule(self, inline_message_id, text, keyboard, digest=None, shown=None):
+        """`digest` identifies the render and `shown` the one displayed until now."""
+        if self.delay <= 0:
+            self.send(inline_message_id, text, keyboard)
+            return
+        with self.lock:
+            pending = self.pending.get(inline_message_id)
+            self.pending[inline_message_id] = Edit(shown if pending is None else pending.shown, digest, text, keyboard)
+            if pending is not None:
+                metrics.EDITS.inc("superseded")
+            if pending is None and inline_message_id not in self.sending:
+                timer = self.timers[inline_message_id] = threading.Timer(self.delay, self.flush, (inline_message_id,))
+                timer.start()
+
+    def flush(self, inline_message_id):
+        """Sends the pending edit of a message now, and those scheduled while it is sent."""
+        with self.lock:
+            if inline_message_id in self.sending:
+                return
+            self.sending.add(inline_message_id)
+        while True:
+            with self.lock:
+                self.timers.pop(inline_message_id, None)
+                edit = self.pending.pop(inline_message_id, None)
+                if edit is None:
+                    self.sending.discard(inline_message_id)
+                    return
+            if edit.digest is not None and edit.digest == edit.shown:
+                metrics.EDITS.inc("reverted")
+                continue
+            try:
+                self.send(inline_message_id, edit.text, edit.keyboard)
+            except Exception:
+                logging.exception("Failed to edit message %s", inline_message_id)
 
-        self.games.set("{}_{}".format(game_id, "text"), text)
-        self.games.set("{}_{}".format(game_id, "keyboard"), str(keyboard))
+    def send(self, inline_message_id, text, keyboard):
+        metrics.EDITS.inc("sent")
+        self.bot.editMessageText(inline_message_id, text, reply_markup=keyboard,
+                                 parse_mode='HTML', disable_web_page_preview=True)
 
-        return text_changed or keyboard_changed
+    def close(self):
+        with self.lock:
+            timers, pending = list(self.timers.values()), list(self.pending)
+        for timer in timers:
+            timer.cancel()
+        for inline_message_id in pending:
+            self.flush(inline_message_id)
 
 
 class HordagoTelegramHandler:
     CACHE_TIME=0 #TODO:Change me when stable
+    MAX_ATTEMPTS = 5
+    FRAGMENTS = 4096
+    BET_KEYBOARD_ACTIONS = ("paso", "kanta", "idoki", "gehiago")
 
-    def __init__(self, token):
-        self.bot = telepot.Bot(token)
-        self.database = HordagoDatabase()
-
-        with open("static/telegram_text_interface.yaml") as f:
-            data = yaml.safe_load(f)
+    def __init__(self, token, database=None, edit_delay=0., interface=None):
+        self.bot = TimedBot(token)
+        self.database = HordagoDatabase() if database is None else database
+        self.edits = EditScheduler(self.bot, edit_delay)
 
+        data = load_interface() if interface is None else interface
         self.texts = data["texts"]
         self.keyboards = data["keyboards"]
         self.states = data["states"]
         self.card_colors = data["card_colors"]
         self.numbers = data["basque_numbers"]
+        # Bound once, rendering calls them for every line
+        self.templates = {name: text.format for name, text in self.texts.items()}
 
-    def start(self):
-        MessageLoop(
-            self.bot,
-            {'inline_query': self.on_inline_query,
-             'chosen_inline_result': self.on_chosen_inline_result,
-             'callback_query': self.on_callback_query}
-        ).run_forever()
+        self.fragments = collections.OrderedDict()
+        self.fragments_lock = threading.Lock()
+        # The state of the game each thread last played an update on, for the profiler
+        self.handling = threading.local()
 
-    def on_inline_query(self, msg):
-        """ Displays always the same result whatever the user input.
-
-        Must give a mockup text an keyboard to get further interaction with the users."""
-
-        play_mus_inline_answer = [
+        self.build_keyboards()
+        self.inline_answer = to_json([
             tnp.InlineQueryResultArticle(
                 id='start',
                 title=self.texts["inline_answer"],
@@ -86,171 +420,173 @@ class HordagoTelegramHandler:
                     inline_keyboard=[[tnp.InlineKeyboardButton(
                         text=self.keyboards["loading"],
                         callback_data="None")]])
-            )]
+            )])
+
+    def start(self):
+        try:
+            MessageLoop(
+                self.bot,
+                {'inline_query': self.on_inline_query,
+                 'chosen_inline_result': self.on_chosen_inline_result,
+                 'callback_query': self.on_callback_query}
+            ).run_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        self.edits.close()
+        self.database.close()
+
+    def on_inline_query(self, msg):
+        """ Displays always the same result whatever the user input.
 
-        self.bot.answerInlineQuery(msg['id'], play_mus_inline_answer, cache_time=self.CACHE_TIME)
+        Must give a mockup text an keyboard to get further interaction with the users."""
+
+        self.bot.answerInlineQuery(msg['id'], self.inline_answer, cache_time=self.CACHE_TIME)
 
     def on_chosen_inline_result(self, msg):
         """ Creates a new game and automatically adds first player"""
 
         from_user, inline_message_id = msg['from'], msg['inline_message_id']
+        self.handling.state = None
 
         #Automaticaly add first player
         game = self.database.new_game(inline_message_id)
-        game.do("add_player", from_user['id'], from_user['first_name'], "0")
-        self.database.save(game)
+        self.handling.state = game.current
+        event = (from_user['id'], "add_player", from_user['first_name'], "0")
+        game.do(event[1], event[0], *event[2:])
 
-        self.update_text(inline_message_id, game)
+        self.update_text(inline_message_id, game, event)
 
     def on_callback_query(self, msg):
         query_id, from_id, query_data = telepot.glance(msg, flavor='callback_query')
         inline_message_id = msg['inline_message_id']
         print('Callback Query:', query_id, from_id, query_data, inline_message_id)
+        self.handling.state = None
 
-        if not self.database.has_game(inline_message_id):
-            self.bot.answerCallbackQuery(query_id, text=self.texts["no_data"])
+        begin = time.perf_counter()
+        try:
+            self.answer_callback(query_id, from_id, msg['from']['first_name'], query_data, inline_message_id)
+        finally:
+            metrics.CALLBACKS.observe(time.perf_counter() - begin)
+
+    def answer_callback(self, query_id, player_id, player_name, query_data, inline_message_id):
+        for _ in range(self.MAX_ATTEMPTS):
+            game, render, version = self.database.get(inline_message_id)
+            if game is None:
+                self.bot.answerCallbackQuery(query_id, text=self.texts["no_data"])
+                return
+
+            self.handling.state = game.current
+            event, answer = self.play(game, player_id, player_name, query_data)
+            try:
+                self.update_text(inline_message_id, game, event, render, version)
+            except ConflictException:
+                # Another worker saved the game since it was loaded, play the click again on its version
+                metrics.CONFLICTS.inc()
+                continue
+            self.bot.answerCallbackQuery(query_id, **answer)
             return
 
-        game = self.database.get(inline_message_id)
+        self.bot.answerCallbackQuery(query_id, text=self.texts["cannot_do_that"])
 
-        if game is None:
-            self.bot.answerCallbackQuery(query_id, text=self.texts["cannot_do_that"])
+    def play(self, game, player_id, player_name, query_data):
+        """ Applies a click to the game.
 
+        Returns the (player_id, action, *args) it accepted, None if none, and the arguments of the answer."""
         if query_data == 'show_cards':
-            cards = game.players[from_id].get_cards()
+            cards = game.players[player_id].get_cards()
             answer = "\n".join("#{}:  {} {}".format(i + 1, card.value, self.card_colors[card.color])
                                for i, card in enumerate(cards))
-            self.bot.answerCallbackQuery(query_id, text=answer, show_alert=True)
-        else:
-            try:
-                split = query_data.split('.')
-                if split[0] == 'add_player':
-                    game.do(split[0], from_id, msg['from']['first_name'], *split[1:])
-                else:
-                    game.do(split[0], from_id, *split[1:])
-            except mus.WrongPlayerException:
-                self.bot.answerCallbackQuery(query_id, text=self.texts["not_your_turn"])
-            except mus.ForbiddenActionException:
-                self.bot.answerCallbackQuery(query_id, text=self.texts["cannot_do_that"])
-            else:
-                self.bot.answerCallbackQuery(query_id)
-
-
-        self.database.save(game)
+            return None, {"text": answer, "show_alert": True}
 
-        self.update_text(inline_message_id, game)
+        try:
+            action, *args = query_data.split('.')
+            if action == 'add_player':
+                args.insert(0, player_name)
+            source, begin = game.current, time.perf_counter()
+            game.do(action, player_id, *args)
+            elapsed = time.perf_counter() - begin
+            metrics.ACTIONS.observe(elapsed, action)
+            if game.current != source:
+                metrics.TRANSITIONS.observe(elapsed, source, game.current)
+        except mus.WrongPlayerException:
+            return None, {"text": self.texts["not_your_turn"]}
+        except mus.ForbiddenActionException:
+            return None, {"text": self.texts["cannot_do_that"]}
+        return (player_id, action, *args), {}
+
+    def fragment(self, game, version, render, *args):
+        """ Returns render(game, *args), computed once per `version` of the current hand of `game`.
+
+        Each hand shuffles a new packet, so the packet seed and shuffle count identify it.
+        `version` must identify everything the fragment displays within the hand, including
+        actions that a save may still refuse."""
+        key = (game.game_id, game.packet.seed, game.packet.shuffles) + version
+        with self.fragments_lock:
+            text = self.fragments.get(key)
+            if text is not None:
+                self.fragments.move_to_end(key)
+                return text
+
+        text = render(game, *args)
+        with self.fragments_lock:
+            self.fragments[key] = text
+            while len(self.fragments) > self.FRAGMENTS:
+                self.fragments.popitem(last=False)
+        return text
 
     def compute_message(self, game):
-        msg = ""
+        templates = self.templates
 
         if game.current == "waiting_room":
-            return self.texts["waiting_room"].format(
+            return templates["waiting_room"](
                 "\n\t".join([player.name for player in game.players.get_team(0)]),
                 "\n\t".join([player.name for player in game.players.get_team(1)])
             )
 
         if game.current == "Trading":
-            exchanges_team_1 = [self.texts["exchange"].format(player.name, len(player.asks))
+            exchanges_team_1 = [templates["exchange"](player.name, len(player.asks))
                                 for player in game.players.get_team(0)]
 
-            exchanges_team_2 = [self.texts["exchange"].format(player.name, len(player.asks))
+            exchanges_team_2 = [templates["exchange"](player.name, len(player.asks))
                                 for player in game.players.get_team(1)]
 
-            return self.texts["trading"].format("\n".join(exchanges_team_1),
-                                                "\n".join(exchanges_team_2))
+            return templates["trading"]("\n".join(exchanges_team_1),
+                                        "\n".join(exchanges_team_2))
 
         if game.current == "Finished":
+            version = tuple(tuple(game.states[state_name].history) for state_name in game.bet_states)
+            return self.fragment(game, ("Finished",) + version, self.finished_summary) + \
+                self.format_history(game, game.state)
 
-            msg = (self.texts["finished"] if not game.players.has_finished() else
-                   self.texts["end_game"].format(game.players.winner_team() + 1))
-
-            msg += self.texts["summary"]
-
-            states_summary = []
-            for state_name in game.bet_states:
-                state = game.states[state_name]
-
-                state_bet = self.texts["state_bet"].format(
-                    self.states[state_name],
-                    state.bet
-                )
-
-                state_bonus = (self.texts["state_bonus"].format(state.bonus)
-                               if state.bonus > 0 else "")
-                state_team = (self.texts["state_team"].format(state.winner.number + 1)
-                              if (state.bet > 0 or state.bonus > 0) else "")
-                state_summary = state_bet + state_bonus + state_team
-                history = self.format_history(game, state, discard_ok=True)
-                if history:
-                    state_summary += "\n" + history
-
-                states_summary.append(state_summary)
-
-
-            msg += "\n".join(states_summary) + "\n\n"
-
-            team_messages = []
-            for i in range(2):
-                intro = self.texts["team_score_end_turn"].format(
-                    i + 1,
-                    game.players.teams[i].score,
-                    game.players.teams[i].score - game.players.teams[i].begin_score,
-                )
-
-                player_cards = "".join([self.texts["show_cards"].format(
-                    player.name,
-                    ", ".join(str(card.value) for card in player.get_cards()))
-                                          for player in game.players.get_team(i)])
-                team_messages.append(intro + player_cards)
-
-            msg += "\n".join(team_messages) + "\n\n"
-
-            msg += self.format_history(game, game.state)
-
-            return msg
-
-        msg = self.texts["title"].format(self.states[str(game.current)])
+        state = game.state
+        msg = templates["title"](self.states[str(game.current)])
         if not game.current == "Speaking":
-            msg += self.texts["current_bet"].format(game.states[game.current].bet)
+            msg += templates["current_bet"](state.bet)
 
-            if game.states[game.current].proposal > 0:
-                msg += self.texts["proposal"].format(game.states[game.current].proposal)
+            if state.proposal > 0:
+                msg += templates["proposal"](state.proposal)
         msg += "\n"
 
         if game.current in game.bet_states:
-            current_state = game.bet_states.index(game.current)
-            state_summaries = []
-
-            for i in range(current_state):
-                state = game.states[game.bet_states[i]]
-
-                state_summary = ""
-                if state.winner is None:
-                    state_summary = self.texts["state_summary_empty"].format(
-                        self.states[game.bet_states[i]])
-                else:
-                    state_summary = self.texts["state_summary"].format(
-                        self.states[game.bet_states[i]],
-                        state.bet,
-                        ("?" if state.deffered else state.winner.number + 1))
-                history = self.format_history(game, state, discard_ok=True)
-                if history:
-                    state_summary += "\n" + history
-                state_summaries.append(state_summary)
-
+            # The lances before the current one are over, their history is all that can still differ
+            state_summaries = [self.fragment(game, (state_name, tuple(game.states[state_name].history)),
+                                             self.lance_summary, state_name)
+                               for state_name in game.bet_states[:game.bet_states.index(game.current)]]
 
             if state_summaries:
                 msg += "\n ".join(state_summaries) + "\n\n"
 
         team_messages = []
         for i in range(2):
-            intro = self.texts["team_score"].format(i + 1, game.players.teams[i].score)
+            intro = templates["team_score"](i + 1, game.players.teams[i].score)
 
             player_messages = []
             for player in game.players.get_team(i):
-                player_name = (self.texts["active_player"]
-                               if game.states[game.current].is_player_authorised(player.id)
-                               else self.texts["inactive_player"]).format(player.name)
+                player_name = (templates["active_player"]
+                               if state.is_player_authorised(player.id)
+                               else templates["inactive_player"])(player.name)
 
                 player_says = ""
                 if game.current == "Pariak":
@@ -263,11 +599,75 @@ class HordagoTelegramHandler:
             team_messages.append(intro + "\n".join(player_messages))
         msg += "\n".join(team_messages)
         msg += "\n\n"
-        msg += self.format_history(game, game.state)
+        msg += self.format_history(game, state)
 
         return msg
 
+    def lance_summary(self, game, state_name):
+        state = game.states[state_name]
+        if state.winner is None:
+            state_summary = self.templates["state_summary_empty"](self.states[state_name])
+        else:
+            state_summary = self.templates["state_summary"](
+                self.states[state_name],
+                state.bet,
+                ("?" if state.deffered else state.winner.number + 1))
+        history = self.format_history(game, state, discard_ok=True)
+        if history:
+            state_summary += "\n" + history
+        return state_summary
+
+    def finished_summary(self, game):
+        """ Everything the message displays at the end of a hand but the confirmations."""
+        templates = self.templates
+        msg = (self.texts["finished"] if not game.players.has_finished() else
+               templates["end_game"](game.players.winner_team() + 1))
+
+        msg += self.texts["summary"]
+
+        states_summary = []
+        for state_name in game.bet_states:
+            state = game.states[state_name]
+
+            state_bet = templates["state_bet"](
+                self.states[state_name],
+                state.bet
+            )
+
+            state_bonus = (templates["state_bonus"](state.bonus)
+                           if state.bonus > 0 else "")
+            state_team = (templates["state_team"](state.winner.number + 1)
+                          if (state.bet > 0 or state.bonus > 0) else "")
+            state_summary = state_bet + state_bonus + state_team
+            history = self.format_history(game, state, discard_ok=True)
+            if history:
+                state_summary += "\n" + history
+
+            states_summary.append(state_summary)
+
+
+        msg += "\n".join(states_summary) + "\n\n"
+
+        team_messages = []
+        for i in range(2):
+            intro = templates["team_score_end_turn"](
+                i + 1,
+                game.players.teams[i].score,
+                game.players.teams[i].score - game.players.teams[i].begin_score,
+            )
+
+            player_cards = "".join([templates["show_cards"](
+                player.name,
+                ", ".join(str(card.value) for card in player.get_cards()))
+                                      for player in game.players.get_team(i)])
+            team_messages.append(intro + player_cards)
+
+        msg += "\n".join(team_messages) + "\n\n"
+        return msg
+
     def format_history(self, game, game_state, discard_ok=False):
+        player_said = self.templates["player_said"]
+        players = game.state.players
         message = ""
 
         for player_id, action, *arguments in game_state.history:
@@ -275,14 +675,32 @@ class HordagoTelegramHandler:
                     continue
             if action == "gehiago":
                 action = self.numbers[int(arguments[0])]
-            message += self.texts["player_said"].format(game.state.players[player_id].name,
-                                                        action)
+            message += player_said(players[player_id].name, action)
 
         return message
 
 
-    def compute_keyboard(self, game):
-        if game.current == "waiting_room":
+    def keyboard_key(self, game):
+        """ Identifies the keyboard of `game` among those build_keyboards() prepared."""
+        if game.current in ("waiting_room", "Speaking", "Trading"):
+            return (game.current,)
+        if game.current == "Finished":
+            return ("Finished", game.players.has_finished())
+        possible_actions = game.state.actions_authorised()
+        if 'ok' in possible_actions:
+            return ("ok",)
+        return tuple(action for action in self.BET_KEYBOARD_ACTIONS if action in possible_actions)
+
+    def build_keyboards(self):
+        """ Builds every keyboard a game can display, and their JSON form sent to Telegram."""
+        keys = [("waiting_room",), ("Speaking",), ("Trading",), ("Finished", False), ("Finished", True), ("ok",)]
+        keys += [key for n in range(len(self.BET_KEYBOARD_ACTIONS) + 1)
+                 for key in itertools.combinations(self.BET_KEYBOARD_ACTIONS, n)]
+        self.markups = {key: self.build_keyboard(key) for key in keys}
+        self.serialized = {key: to_json(markup) for key, markup in self.markups.items()}
+
+    def build_keyboard(self, key):
+        if key == ("waiting_room",):
             join_teams = [
                 tnp.InlineKeyboardButton(text=self.keyboards["join_team"][1],
                                          callback_data="add_player.0"),
@@ -299,54 +717,63 @@ class HordagoTelegramHandler:
             ]
             return tnp.InlineKeyboardMarkup(inline_keyboard=kb)
 
-        if game.current == "Finished":
+        if key[:1] == ("Finished",):
             kb = [[tnp.InlineKeyboardButton(text=self.keyboards["new_game"], callback_data="ok")
-                  if game.players.has_finished() else
+                  if key[1] else
                   tnp.InlineKeyboardButton(text=self.keyboards["ok"], callback_data="ok")]]
 
             return tnp.InlineKeyboardMarkup(inline_keyboard=kb)
 
         kb = [[tnp.InlineKeyboardButton(text=self.keyboards["show_cards"], callback_data="show_cards")]]
 
-        if game.current == "Speaking":
+        if key == ("Speaking",):
             kb.append([tnp.InlineKeyboardButton(text=self.keyboards["mintza"], callback_data="mintza"),
                        tnp.InlineKeyboardButton(text=self.keyboards["mus"], callback_data="mus")])
 
-        elif game.current == "Trading":
+        elif key == ("Trading",):
             choices = [tnp.InlineKeyboardButton(text=self.keyboards["change"].format(i),
                                                 callback_data="change.{}".format(i))
                        for i in range(1, 5)]
             kb += [choices[:2], choices[2:]]
             kb.append([tnp.InlineKeyboardButton(text=self.keyboards["confirm"], callback_data="confirm")])
 
+        elif key == ("ok",):
+            kb.append([tnp.InlineKeyboardButton(text=self.keyboards["ok"], callback_data="ok")])
+
         else:
-            possible_actions = game.states[game.current].actions_authorised()
-            if 'ok' in possible_actions:
-                kb.append([tnp.InlineKeyboardButton(text=self.keyboards["ok"], callback_data="ok")])
-                return tnp.InlineKeyboardMarkup(inline_keyboard=kb)
-            if 'paso' in possible_actions:
+            if 'paso' in key:
                 kb.append([tnp.InlineKeyboardButton(text=self.keyboards["imido"], callback_data="imido"),
                            tnp.InlineKeyboardButton(text=self.keyboards["paso"], callback_data="paso")])
-            if 'kanta' in possible_actions:
+            if 'kanta' in key:
                 kb.append([tnp.InlineKeyboardButton(text=self.keyboards["kanta"], callback_data="kanta"),
                            tnp.InlineKeyboardButton(text=self.keyboards["tira"], callback_data="tira")])
-            if 'idoki' in possible_actions:
+            if 'idoki' in key:
                 kb.append([tnp.InlineKeyboardButton(text=self.keyboards["idoki"], callback_data="idoki"),
                            tnp.InlineKeyboardButton(text=self.keyboards["tira"], callback_data="tira")])
-            if 'gehiago' in possible_actions:
+            if 'gehiago' in key:
                 gehiago = [tnp.InlineKeyboardButton(text=self.numbers[i], callback_data="gehiago.{}".format(i)) for i in [1, 2, 3, 4, 5, 10]]
                 kb += [gehiago[:3], gehiago[3:]]
                 kb.append([tnp.InlineKeyboardButton(text=self.keyboards["hordago"], callback_data="hordago")])
 
         return tnp.InlineKeyboardMarkup(inline_keyboard=kb)
 
-    def update_text(self, inline_message_id, game):
+    def compute_keyboard(self, game):
+        return self.markups[self.keyboard_key(game)]
+
+    def update_text(self, inline_message_id, game, event=None, render=None, version=None):
+        """ Saves the game with the digest of its message, which is only sent when it changed from `render`.
+
+        The edit goes through self.edits, which may delay it and merge it with the next ones."""
+        begin = time.perf_counter()
         message_update = self.compute_message(game)
-        keyboard_update = self.compute_keyboard(game)
-
-        if self.database.response_has_changed(inline_message_id, message_update, keyboard_update):
-            self.bot.editMessageText(inline_message_id,
-                                    message_update,
-                                    reply_markup=keyboard_update,
-                                    parse_mode='HTML',
-                                    disable_web_page_preview=True)
+        rendered = time.perf_counter()
+        keyboard_key = self.keyboard_key(game)
+        metrics.RENDERS.observe(rendered - begin, "message")
+        metrics.RENDERS.observe(time.perf_counter() - rendered, "keyboard")
+        digest = render_digest(message_update, keyboard_key)
+
+        self.database.save(game, event, digest if digest != render else None, version)
+        if digest == render:
+            metrics.EDITS.inc("unchanged")
+        else:
+            self.edits.schedule(inline_message_id, message_update, self.serialized[keyboard_key], digest, render)
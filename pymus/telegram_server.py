@@ -1,13 +1,81 @@
+import time
+STARTED = time.perf_counter()
+
 import argparse
 import logging
+import sys
+
+import metrics
+import storage
+
+from profiler import SlowCallbackProfiler
+from runtime import AsyncRuntime
+from telegram import HordagoDatabase, HordagoTelegramHandler, load_interface
+IMPORTED = time.perf_counter()
+
+
+class Phases:
+    """ Times the steps of the startup, each one from the end of the previous one."""
+
+    def __init__(self, start):
+        self.last = start
+        self.times = []
+
+    def done(self, name, now=None):
+        now = time.perf_counter() if now is None else now
+        self.times.append((name, now - self.last))
+        self.last = now
+
+    def report(self):
+        total = sum(seconds for _, seconds in self.times)
+        return ", ".join("{} {:.1f} ms".format(name, seconds * 1e3)
+                         for name, seconds in self.times + [("total", total)])
 
-from telegram import HordagoTelegramHandler
 
 def main():
+    phases = Phases(STARTED)
+    phases.done("imports", IMPORTED)
 
     parser = argparse.ArgumentParser()
     parser.add_argument("secret_file", help="A file containing the Telegram Bot secret")
     parser.add_argument("-v", "--verbose", help="Be verbose", action="store_true")
+    parser.add_argument("--storage", choices=sorted(storage.BACKENDS), default="redis",
+                        help="Where games are kept, the memory storage forgets them on exit")
+    parser.add_argument("--redis-host", default="localhost")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--redis-db", type=int, default=0)
+    parser.add_argument("--redis-pool-size", type=int, metavar="N", help="Maximum number of Redis connections")
+    parser.add_argument("--sqlite-path", default="pymus.sqlite", help="The SQLite database file")
+    parser.add_argument("--sqlite-commit-every", type=int, default=32, metavar="N",
+                        help="Commit SQLite writes every N saves, and at the latest a second after a save")
+    parser.add_argument("-s", "--snapshot-every", type=int, metavar="N",
+                        help="Log every action and only write the whole game every N actions")
+    parser.add_argument("-c", "--cache-size", type=int, default=0, metavar="N",
+                        help="Keep the last N games used in memory")
+    parser.add_argument("--max-idle", type=float, default=600, metavar="SECONDS",
+                        help="Drop cached games unused for that long")
+    parser.add_argument("--write-behind", action="store_true",
+                        help="Only write cached games when they leave the cache or the server stops")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="Handle the updates of different games concurrently")
+    parser.add_argument("-w", "--workers", type=int, default=8, metavar="N",
+                        help="With --async, how many updates are handled at once")
+    parser.add_argument("--queue-size", type=int, default=32, metavar="N",
+                        help="With --async, how many updates of one game can wait, the next ones are dropped")
+    parser.add_argument("--edit-delay", type=float, default=0.3, metavar="SECONDS",
+                        help="Wait that long before editing a message, to send a single edit for a burst of clicks")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT",
+                        help="Serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="Where to serve the metrics")
+    parser.add_argument("--profile-slow", type=float, metavar="SECONDS",
+                        help="Profile the next updates after one takes longer than that")
+    parser.add_argument("--profile-dir", default="profiles", help="Where to write the profiles")
+    parser.add_argument("--profile-count", type=int, default=3, metavar="N",
+                        help="How many updates to profile after a slow one")
+    parser.add_argument("--profile-sample-rate", type=float, default=1., metavar="RATE",
+                        help="Probability that each of these updates is profiled")
+    parser.add_argument("--profile-cooldown", type=float, default=60., metavar="SECONDS",
+                        help="How long a slow update waits after the previous one before profiling again")
     args = parser.parse_args()
 
     with open(args.secret_file) as f:
@@ -19,7 +87,47 @@ def main():
             format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
         )
 
-    HordagoTelegramHandler(secret).start()
+    phases.done("arguments")
+
+    if args.storage == "redis":
+        backend = storage.RedisStorage(args.redis_host, args.redis_port, args.redis_db, args.redis_pool_size)
+    elif args.storage == "sqlite":
+        backend = storage.SQLiteStorage(args.sqlite_path, args.sqlite_commit_every)
+    else:
+        backend = storage.MemoryStorage()
+    # Opened now rather than by the first click, as many as the threads that may use them at once
+    connections = min(args.workers, args.redis_pool_size or args.workers) if args.use_async else 1
+    try:
+        backend.check(connections)
+    except Exception as error:
+        sys.exit("The {} storage cannot be used: {}".format(args.storage, error))
+    phases.done("storage")
+
+    interface = load_interface()
+    phases.done("interface")
+
+    database = HordagoDatabase(backend, args.snapshot_every, args.cache_size, args.max_idle, args.write_behind)
+    handler = HordagoTelegramHandler(secret, database, args.edit_delay, interface)
+    if args.profile_slow is not None:
+        SlowCallbackProfiler(handler, args.profile_dir, args.profile_slow, args.profile_count,
+                             args.profile_sample_rate, args.profile_cooldown)
+    phases.done("handler")
+
+    try:
+        handler.bot.getMe()
+    except Exception as error:
+        # Polling retries until Telegram answers
+        logging.warning("Telegram cannot be reached yet: %s", error)
+    phases.done("telegram")
+
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port, args.metrics_host)
+    print("Started:", phases.report())
+
+    if args.use_async:
+        AsyncRuntime(handler, args.workers, args.queue_size).start()
+    else:
+        handler.start()
 
 if __name__=="__main__":
     main()
@@ -1,11 +1,46 @@
 import sys
 sys.path.append("pymus")
 
+import asyncio
+import copyreg
+import io
+import itertools
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
 import unittest
+import urllib.request
+import codec
+import metrics
 import mus
+import profiler
+import runtime
+import simulator
+import storage
 
 from mus import Game, Card, Team
 
+try:
+    import telegram
+except ImportError:
+    telegram = None
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+try:
+    import numpy
+    import evaluator
+    import equity
+    import dealer
+except ImportError:
+    numpy = None
+
 class TestInitialMus(unittest.TestCase):
 
     def setUp(self):
@@ -397,6 +432,18 @@ class TestHaundiaComparisons(TestCardComparisons):
         self.compute_winner()
         self.assertEqual(self.state.winner.number, 0)
 
+    def test_haundia_ranking(self):
+        self.game.players[self.christophe].cards = sorted([Card(value=4, color='Oros'),
+                                                           Card(value=7, color='Oros'),
+                                                           Card(value=10, color='Bastos'),
+                                                           Card(value=11, color='Copas')])
+        self.game.players[self.gerard].cards = sorted([Card(value=2, color='Oros'),
+                                                       Card(value=6, color='Oros'),
+                                                       Card(value=10, color='Bastos'),
+                                                       Card(value=12, color='Copas')])
+        self.compute_winner()
+        self.assertEqual([player.id for player in self.state.ranking], [self.gerard, self.christophe])
+
 
 class TestTipaComparisons(TestCardComparisons):
     game_state = "Tipia"
@@ -589,5 +636,857 @@ class TestJokuaComparisons(TestCardComparisons):
         self.assertEqual(self.state.winner.number, 0)
 
 
+class TestLanceTables(unittest.TestCase):
+    def hand(self, hand_type, *values):
+        return hand_type([Card(value=value, color='Oros') for value in values])
+
+    def test_table_size(self):
+        for hand_type in (mus.HaundiaHand, mus.TipiaHand, mus.PariakHand, mus.JokuaHand):
+            self.assertEqual(len(hand_type.table), 715)
+
+    def test_pariak_bonus(self):
+        self.assertEqual(self.hand(mus.PariakHand, 5, 5, 5, 5).bonus(), 3)
+        self.assertEqual(self.hand(mus.PariakHand, 5, 5, 7, 7).bonus(), 3)
+        self.assertEqual(self.hand(mus.PariakHand, 5, 5, 5, 7).bonus(), 2)
+        self.assertEqual(self.hand(mus.PariakHand, 5, 5, 6, 7).bonus(), 1)
+        self.assertFalse(self.hand(mus.PariakHand, 4, 5, 6, 7).has_hand())
+
+    def test_jokua_order(self):
+        la_real = self.hand(mus.JokuaHand, 1, 10, 10, 10)
+        thirty_two = self.hand(mus.JokuaHand, 2, 10, 10, 10)
+        forty = self.hand(mus.JokuaHand, 10, 10, 10, 10)
+        thirty = self.hand(mus.JokuaHand, 10, 10, 5, 5)
+        self.assertTrue(thirty_two < la_real)
+        self.assertTrue(forty < thirty_two)
+        self.assertTrue(thirty < forty)
+        self.assertEqual(la_real.bonus(), 3)
+        self.assertEqual(forty.bonus(), 2)
+        self.assertEqual(thirty.bonus(), 0)
+
+
+class TestCard(unittest.TestCase):
+    def test_interned(self):
+        self.assertIs(Card(value=12, color='Oros'), Card(39))
+        for card in mus.Packet().take(4):
+            self.assertIs(card, Card(card.index()))
+
+    def test_immutable(self):
+        with self.assertRaises(AttributeError):
+            Card(0).value = 12
+
+    def test_no_arguments(self):
+        with self.assertRaises(TypeError):
+            Card()
+
+    def test_pickle(self):
+        self.assertIs(pickle.loads(pickle.dumps(Card(17))), Card(17))
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestBatchEvaluator(unittest.TestCase):
+    def test_agrees_with_hands(self):
+        indices = numpy.random.default_rng(0).permuted(numpy.tile(numpy.arange(40), (500, 1)), axis=1)[:, :4]
+        ranks = evaluator.evaluate(indices)
+        for i, row in enumerate(indices):
+            cards = [Card(int(index)) for index in row]
+            self.assertEqual(ranks.haundia[i], mus.HaundiaHand(cards).rank())
+            self.assertEqual(ranks.tipia[i], mus.TipiaHand(cards).rank())
+            self.assertEqual(ranks.pariak[i], mus.PariakHand(cards).rank())
+            self.assertEqual(ranks.jokua[i], mus.JokuaHand(cards).rank())
+            self.assertEqual(ranks.pariak_bonus[i], mus.PariakHand(cards).bonus())
+            self.assertEqual(ranks.jokua_bonus[i], mus.JokuaHand(cards).bonus())
+
+    def test_bad_shape(self):
+        self.assertRaises(ValueError, evaluator.evaluate, numpy.zeros((3, 5), dtype=int))
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestMonteCarloEquity(unittest.TestCase):
+    hand = [Card(value=12, color='Oros'), Card(value=12, color='Copas'),
+            Card(value=12, color='Bastos'), Card(value=12, color='Espadas')]
+
+    def test_four_kings(self):
+        result = equity.monte_carlo_equity(self.hand, 2, samples=2000, seed=0)
+        self.assertEqual(result.haundia.probability, 1.)
+        self.assertEqual(result.pariak.probability, 1.)
+        self.assertEqual(result.tipia.probability, 0.)
+        self.assertTrue(result.jokua.low <= result.jokua.probability <= result.jokua.high)
+
+    def test_bad_table(self):
+        self.assertRaises(ValueError, equity.monte_carlo_equity, self.hand, 3)
+        self.assertRaises(ValueError, equity.monte_carlo_equity, self.hand[:3], 2)
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestExactEquity(unittest.TestCase):
+    hand = [Card(value=12, color='Oros'), Card(value=11, color='Oros'),
+            Card(value=1, color='Copas'), Card(value=1, color='Oros')]
+
+    def test_matches_card_enumeration(self):
+        remaining = [card.index() for card in mus.Packet.CARDS if card not in self.hand]
+        opponents = numpy.array(list(itertools.combinations(remaining, 4)))
+        own = numpy.tile([card.index() for card in self.hand], (len(opponents), 1))
+        for seat in range(2):
+            seats = [own, opponents] if seat == 0 else [opponents, own]
+            ranks = evaluator.evaluate(numpy.stack(seats, axis=1).reshape(-1, 4))
+            ranks = evaluator.HandRanks(*(rank.reshape(-1, 2) for rank in ranks))
+            expected = [won.mean() for won in equity.lance_wins(ranks, seat)]
+            result = equity.exact_equity(self.hand, 2, seat=seat)
+            for lance, probability in zip(equity.LANCES, expected):
+                self.assertAlmostEqual(getattr(result, lance).probability, probability)
+
+    def test_cached(self):
+        equity.exact_equity(self.hand, 2)
+        hits = equity.exact_wins.cache_info().hits
+        equity.exact_equity(list(reversed(self.hand)), 2)
+        self.assertEqual(equity.exact_wins.cache_info().hits, hits + 1)
+
+
+class TestPacket(unittest.TestCase):
+    def test_seeded(self):
+        self.assertEqual(mus.Packet(7).take(60), mus.Packet(7).take(60))
+        self.assertNotEqual(mus.Packet(7).take(40), mus.Packet(8).take(40))
+
+    def test_trade_keeps_every_card(self):
+        packet = mus.Packet(1)
+        hand = packet.take(8)
+        for i in range(200):
+            hand[i % 8] = packet.trade(hand[i % 8])[0]
+            indices = [card.index() for card in hand] + packet.unused_cards + packet.used_cards
+            self.assertEqual(sorted(indices), list(range(40)))
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestBatchDeal(unittest.TestCase):
+    def test_deal(self):
+        result = dealer.deal(100, 4, rng=0)
+        self.assertEqual(result.hands.shape, (100, 4, 4))
+        self.assertEqual(result.draws.shape, (100, 24))
+        for deck, hands, draws in zip(*result):
+            self.assertEqual(sorted(deck), list(range(40)))
+            self.assertEqual(sorted(hands.ravel().tolist() + draws.tolist()), list(range(40)))
+            self.assertEqual(hands[1].tolist(), sorted(deck[4:8]))
+
+    def test_table_size(self):
+        self.assertRaises(ValueError, dealer.deal, 10, 3)
+
+
+class TestSeats(unittest.TestCase):
+    def setUp(self):
+        self.game = Game(0)
+        for player_id, name, team in [(1, "Christophe", "0"), (2, "Gerard", "0"),
+                                      (3, "Michel", "1"), (4, "Robert", "1")]:
+            self.game.do("add_player", player_id, name, team)
+        self.game.do("start", 1)
+
+    def seat_ids(self):
+        return [player.id for player in self.game.players.get_all_echku_sorted()]
+
+    def test_initial_seats(self):
+        self.assertEqual(self.seat_ids(), [1, 3, 2, 4])
+        self.assertEqual([player.index for player in self.game.players.get_all_echku_sorted()], [0, 1, 2, 3])
+
+    def test_rotation(self):
+        self.game.players.set_echku()
+        self.assertEqual(self.seat_ids(), [3, 2, 4, 1])
+        self.assertEqual(self.game.players.echku.id, 3)
+
+    def test_read_only(self):
+        seats = self.game.players.get_all_echku_sorted()
+        self.game.players.set_echku()
+        self.assertEqual([player.id for player in seats], [1, 3, 2, 4])
+        self.assertIsInstance(self.game.players.get_all(), tuple)
+
+    def test_lookup(self):
+        self.assertEqual(self.game.players[4].name, "Robert")
+        self.assertRaises(IndexError, self.game.players.__getitem__, 5)
+
+    def test_team_authorisation(self):
+        players = self.game.players
+        players.authorise_team(players.get_team(1))
+        self.assertEqual(sorted(self.game.state.players_authorised()), [3, 4])
+        self.assertTrue(players[3].is_authorised)
+        self.assertFalse(players[1].is_authorised)
+        players.toggle_authorisation()
+        self.assertEqual(sorted(self.game.state.players_authorised()), [1, 2])
+        players.authorise_player(players[4])
+        self.assertEqual(self.game.state.players_authorised(), [4])
+
+
+class TestFourPlayerJokua(unittest.TestCase):
+    def setUp(self):
+        self.game = Game(0)
+        game_cards = sorted([Card(value=1, color='Oros'), Card(value=10, color='Oros'),
+                             Card(value=11, color='Bastos'), Card(value=12, color='Copas')])
+        nogame_cards = sorted([Card(value=1, color='Copas'), Card(value=2, color='Oros'),
+                               Card(value=3, color='Bastos'), Card(value=4, color='Copas')])
+        for player_id, team in [(1, "0"), (2, "0"), (3, "1"), (4, "1")]:
+            self.game.do("add_player", player_id, str(player_id), team)
+        self.game.do("start", 1)
+        # Seats in echku order are 1, 3, 2, 4
+        for player_id, cards in [(1, game_cards), (3, nogame_cards), (2, nogame_cards), (4, game_cards)]:
+            self.game.players[player_id].cards = cards
+
+        self.game.do("mintza", 1)
+        for _ in range(2):
+            for player_id in (1, 3, 2, 4):
+                self.game.do("paso", player_id)
+        for player_id in (1, 3, 2, 4):
+            self.game.do("ok", player_id)
+
+    def test_paso_skips_players_without_game(self):
+        self.assertEqual("Jokua", self.game.current)
+        self.game.do("paso", 1)
+        self.assertEqual(self.game.state.players_authorised(), [4])
+        self.game.do("paso", 4)
+        self.assertEqual("Finished", self.game.current)
+
+
+class TestSimulator(unittest.TestCase):
+    def test_full_games(self):
+        for policies in ([simulator.RandomPolicy() for _ in range(4)],
+                         [simulator.PassivePolicy(), simulator.RandomPolicy()]):
+            report = simulator.simulate(policies, 20, seed=0)
+            self.assertEqual(sum(report.wins), 20)
+            self.assertEqual(report.stalled, 0)
+
+    def test_reproducible(self):
+        policies = [simulator.RandomPolicy(), simulator.RandomPolicy()]
+        self.assertEqual(simulator.play(policies, seed=3), simulator.play(policies, seed=3))
+
+
+class TestCodec(unittest.TestCase):
+    def test_round_trip(self):
+        policies = [simulator.RandomPolicy() for _ in range(4)]
+        game = simulator.new_game(policies, seed=1)
+        while not (game.current == "Finished" and game.players.has_finished()):
+            data = codec.encode(game)
+            decoded = codec.decode(data)
+            self.assertEqual(codec.encode(decoded), data)
+            self.assertEqual(decoded.current, game.current)
+            self.assertEqual([player.cards for player in decoded.players.get_all_echku_sorted()],
+                             [player.cards for player in game.players.get_all_echku_sorted()])
+            self.assertEqual(decoded.state.actions_authorised(), game.state.actions_authorised())
+            simulator.play_move(game, policies)
+
+    def test_waiting_room(self):
+        game = Game("-42")
+        game.do("add_player", 1, "Léa", "0")
+        game.do("add_player", 2, "Ion", "1")
+        game.do("remove_player", 2)
+        decoded = codec.decode(codec.encode(game))
+        self.assertEqual(decoded.game_id, "-42")
+        self.assertEqual(decoded.state.history, game.state.history)
+        self.assertEqual([player.name for player in decoded.players], ["Léa"])
+
+    def test_smaller_than_pickle(self):
+        game = simulator.new_game([simulator.RandomPolicy() for _ in range(4)], seed=0)
+        self.assertLess(len(codec.encode(game)) * 4, len(pickle.dumps(game)))
+
+    def test_invalid_data(self):
+        data = codec.encode(simulator.new_game([simulator.RandomPolicy() for _ in range(2)], seed=0))
+        self.assertTrue(codec.is_encoded(data))
+        self.assertFalse(codec.is_encoded(pickle.dumps(Game(0))))
+        for invalid in (b"XYZ" + data[3:], data[:3] + bytes([codec.VERSION + 1]) + data[4:], data[:-1], data[:20]):
+            with self.assertRaises(codec.DecodeError):
+                codec.decode(invalid)
+        for length in range(len(data)):
+            with self.assertRaises(codec.DecodeError):
+                codec.decode(data[:length])
+
+
+class TestEventLog(unittest.TestCase):
+    def play(self, game, policies, moves):
+        events = []
+        for _ in range(moves):
+            player, (action, *args) = simulator.next_move(game, policies)
+            for move in ([[position] for position in args] if action == "change" else [args]):
+                game.do(action, player.id, *move)
+                events.append(codec.encode_event(game, player.id, action, *move))
+        return events
+
+    def test_replay(self):
+        policies = [simulator.RandomPolicy() for _ in range(4)]
+        game = simulator.new_game(policies, seed=2)
+        snapshot = codec.encode(game)
+        events = self.play(game, policies, 60)
+        self.assertEqual(codec.encode(codec.replay(codec.decode(snapshot), events)), codec.encode(game))
+
+    def test_other_deal(self):
+        policies = [simulator.RandomPolicy() for _ in range(2)]
+        game = simulator.new_game(policies, seed=2)
+        snapshot = codec.encode(game)
+        events = self.play(game, policies, 30)
+        other = codec.decode(snapshot)
+        other.packet.shuffles += 1
+        with self.assertRaises(codec.DecodeError):
+            codec.replay(other, events)
+
+    def test_event(self):
+        game = Game(0)
+        self.assertEqual(codec.decode_event(codec.encode_event(game, 7, "gehiago", "5")), (7, "gehiago", ["5"], 1))
+
+
+class TestMemoryStorage(unittest.TestCase):
+    def create(self):
+        return storage.MemoryStorage()
+
+    def setUp(self):
+        self.storage = self.create()
+
+    def tearDown(self):
+        self.storage.close()
+
+    def test_missing(self):
+        self.storage.check()
+        self.assertFalse(self.storage.exists("game"))
+        self.assertEqual(self.storage.load("game"), (None, [], None, 0))
+
+    def test_tail(self):
+        self.assertEqual(self.storage.store("game", b"first", reset=True), (0, 1))
+        self.assertEqual(self.storage.store("game", None, [b"a", b"b"], b"render"), (2, 2))
+        self.assertTrue(self.storage.exists("game"))
+        self.assertEqual(self.storage.load("game"), (b"first", [b"a", b"b"], b"render", 2))
+
+        self.assertEqual(self.storage.store("game", b"second", [b"c"]), (0, 3))
+        self.assertEqual(self.storage.store("game", None, [b"d"]), (1, 4))
+        self.assertEqual(self.storage.load("game"), (b"second", [b"d"], b"render", 4))
+
+        self.storage.store("game", b"new", reset=True)
+        self.assertEqual(self.storage.load("game"), (b"new", [], None, 1))
+
+    def test_conflict(self):
+        self.storage.store("game", b"first", reset=True)
+        self.assertEqual(self.storage.store("game", None, [b"a"], version=1), (1, 2))
+        with self.assertRaises(storage.ConflictException):
+            self.storage.store("game", None, [b"b"], version=1)
+        self.assertEqual(self.storage.load("game"), (b"first", [b"a"], None, 2))
+
+
+class TestSQLiteStorage(TestMemoryStorage):
+    def create(self):
+        return storage.SQLiteStorage(":memory:", commit_every=2)
+
+    def test_commit_interval(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "games.sqlite")
+            backend = storage.SQLiteStorage(path, commit_every=100, commit_interval=.05)
+            backend.store("game", b"snapshot")
+            other = storage.SQLiteStorage(path)
+            self.assertFalse(other.exists("game"))
+            time.sleep(.3)
+            # Committed without another store, which releases the write lock as well
+            self.assertTrue(other.exists("game"))
+            other.store("other", b"snapshot")
+            other.close()
+            backend.close()
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class TestRedisStorage(TestMemoryStorage):
+    def create(self):
+        return storage.RedisStorage(connection_class=fakeredis.FakeRedisConnection, server=fakeredis.FakeServer())
+
+    def test_round_trips(self):
+        self.storage.store("game", b"first", reset=True)
+        pool = self.storage.pool
+        get_connection, round_trips = pool.get_connection, []
+        pool.get_connection = lambda *args, **kwargs: round_trips.append(args) or get_connection(*args, **kwargs)
+        self.storage.load("game")
+        self.storage.store("game", None, [b"a"], b"render")
+        self.assertEqual(len(round_trips), 2)
+
+
+@unittest.skipIf(telegram is None, "telepot is not installed")
+class TestHordagoDatabase(unittest.TestCase):
+    def play(self, database, moves):
+        """Plays moves on a reference game and on the same game loaded from `database` before each of them."""
+        policies = [simulator.PassivePolicy(), simulator.RandomPolicy()]
+        game = simulator.new_game(policies, seed=3)
+        game.game_id = "game"
+        database.storage.store("game", codec.encode(game), reset=True)
+        for _ in range(moves):
+            loaded = database.get("game").game
+            player, (action, *args) = simulator.next_move(game, policies)
+            for move in ([[position] for position in args] if action == "change" else [args]):
+                game.do(action, player.id, *move)
+                loaded.do(action, player.id, *move)
+                database.save(loaded, (player.id, action, *move), b"render")
+        database.close()
+        return game
+
+    def add_player(self, database, game_id, player_id, name):
+        game = database.get(game_id).game
+        game.do("add_player", player_id, name, "0")
+        database.save(game, (player_id, "add_player", name, "0"))
+
+    def stored_players(self, database, game_id):
+        """Returns the players of the game as another database, without a cache, loads it."""
+        other = telegram.HordagoDatabase(database.storage, database.snapshot_every)
+        return [player.name for player in other.get(game_id).game.players]
+
+    def test_modes(self):
+        for snapshot_every, cache_size, write_behind in itertools.product([None, 1, 7], [0, 2], [False, True]):
+            backend = storage.MemoryStorage()
+            game = self.play(telegram.HordagoDatabase(backend, snapshot_every, cache_size, 600, write_behind), 80)
+            loaded, render, _ = telegram.HordagoDatabase(backend, snapshot_every).get("game")
+            self.assertEqual(codec.encode(loaded), codec.encode(game))
+            self.assertEqual(render, b"render")
+
+    def test_missing(self):
+        database = telegram.HordagoDatabase(storage.MemoryStorage())
+        self.assertFalse(database.has_game("game"))
+        self.assertEqual(database.get("game"), (None, None, None))
+
+    def test_conflict(self):
+        backend = storage.MemoryStorage()
+        for snapshot_every in (None, 3):
+            database = telegram.HordagoDatabase(backend, snapshot_every, cache_size=2)
+            other = telegram.HordagoDatabase(backend, snapshot_every)
+            database.new_game("game")
+            game, _, version = database.get("game")
+            game.do("add_player", 1, "Ane", "0")
+            database.save(game, (1, "add_player", "Ane", "0"), version=version)
+
+            game, _, version = database.get("game")
+            concurrent, _, concurrent_version = other.get("game")
+            self.assertEqual(version, concurrent_version)
+            concurrent.do("add_player", 2, "Jon", "1")
+            other.save(concurrent, (2, "add_player", "Jon", "1"), version=concurrent_version)
+            game.do("add_player", 3, "Miren", "1")
+            with self.assertRaises(storage.ConflictException):
+                database.save(game, (3, "add_player", "Miren", "1"), version=version)
+
+            game, _, version = database.get("game")
+            self.assertEqual([player.name for player in game.players], ["Ane", "Jon"])
+
+    def test_write_behind(self):
+        for snapshot_every in (None, 3):
+            backend = storage.MemoryStorage()
+            database = telegram.HordagoDatabase(backend, snapshot_every, cache_size=2, write_behind=True)
+            database.new_game("game")
+            self.add_player(database, "game", 1, "Ane")
+            self.add_player(database, "game", 2, "Jon")
+            self.assertEqual(self.stored_players(database, "game"), [])
+            database.close()
+            self.assertEqual(self.stored_players(database, "game"), ["Ane", "Jon"])
+
+    def test_write_through(self):
+        database = telegram.HordagoDatabase(storage.MemoryStorage(), 3, cache_size=2)
+        database.new_game("game")
+        self.add_player(database, "game", 1, "Ane")
+        self.assertEqual(self.stored_players(database, "game"), ["Ane"])
+        self.assertIn("game", database.cache)
+        database.close()
+
+    def test_eviction(self):
+        database = telegram.HordagoDatabase(storage.MemoryStorage(), cache_size=1, write_behind=True)
+        database.new_game("game")
+        self.add_player(database, "game", 1, "Ane")
+        database.new_game("other")
+        self.assertEqual(list(database.cache), ["other"])
+        self.assertEqual(self.stored_players(database, "game"), ["Ane"])
+        database.close()
+
+    def test_idle_write_behind(self):
+        backend = storage.MemoryStorage()
+        database = telegram.HordagoDatabase(backend, cache_size=2, max_idle=.05, write_behind=True)
+        store, unlocked = backend.store, []
+
+        def probed_store(*args, **kwargs):
+            # Another thread can take the lock meanwhile
+            def probe():
+                unlocked.append(database.lock.acquire(timeout=1))
+                database.lock.release()
+            thread = threading.Thread(target=probe)
+            thread.start()
+            thread.join()
+            return store(*args, **kwargs)
+        backend.store = probed_store
+
+        database.new_game("game")
+        game = database.get("game").game
+        game.do("add_player", 1, "Ane", "0")
+        database.save(game, (1, "add_player", "Ane", "0"))
+        self.assertEqual(len(codec.decode(backend.load("game")[0]).players.get_all()), 0)
+        # Written by the idle sweep, without another click
+        time.sleep(.3)
+        self.assertNotIn("game", database.cache)
+        self.assertEqual([player.name for player in codec.decode(backend.load("game")[0]).players], ["Ane"])
+        self.assertEqual(unlocked, [True, True])
+        database.close()
+
+
+class RecordingHandler:
+    """Stands for HordagoTelegramHandler: records the updates it handles, one game at a time."""
+
+    def __init__(self):
+        self.handled = []
+        self.running = set()
+        self.alone = True
+        self.overlaps = 0
+        self.lock = threading.Lock()
+
+    def on_callback_query(self, msg):
+        game_id = msg["inline_message_id"]
+        with self.lock:
+            self.alone &= game_id not in self.running
+            self.overlaps += bool(self.running)
+            self.running.add(game_id)
+        time.sleep(0.01)
+        with self.lock:
+            self.running.discard(game_id)
+            self.handled.append((game_id, msg["data"]))
+
+    on_chosen_inline_result = on_inline_query = on_callback_query
+
+
+class TestAsyncRuntime(unittest.TestCase):
+    def test_queues(self):
+        handler = RecordingHandler()
+        updates = [{"update_id": i, "callback_query": {"inline_message_id": "game {}".format(i % 3), "data": i}}
+                   for i in range(12)]
+
+        async def run(runtime):
+            for update in updates:
+                runtime.dispatch(update)
+            await runtime.drain()
+
+        asyncio.run(run(runtime.AsyncRuntime(handler, workers=3)))
+        self.assertEqual(len(handler.handled), len(updates))
+        for game in range(3):
+            self.assertEqual([data for game_id, data in handler.handled if game_id == "game {}".format(game)],
+                             list(range(game, 12, 3)))
+        self.assertTrue(handler.alone)
+        self.assertGreater(handler.overlaps, 0)
+
+    def test_route(self):
+        queries = runtime.AsyncRuntime(RecordingHandler())
+        self.assertEqual(queries.route({"update_id": 1, "inline_query": {"id": "1"}}),
+                         ("inline_query", {"id": "1"}, None))
+        self.assertEqual(queries.route({"update_id": 1, "message": {}}), (None, None, None))
+
+
+class RecordingBot:
+    def __init__(self):
+        self.edits = []
+
+    def editMessageText(self, inline_message_id, text, **kwargs):
+        self.edits.append((inline_message_id, text, kwargs["reply_markup"]))
+
+
+@unittest.skipIf(telegram is None, "telepot is not installed")
+class TestEditScheduler(unittest.TestCase):
+    def test_at_once(self):
+        bot = RecordingBot()
+        telegram.EditScheduler(bot).schedule("a", "text", "keyboard")
+        self.assertEqual(bot.edits, [("a", "text", "keyboard")])
+
+    def test_coalesce(self):
+        bot = RecordingBot()
+        edits = telegram.EditScheduler(bot, 60)
+        for i in range(3):
+            edits.schedule("a", "text {}".format(i), "keyboard", i, None)
+        edits.schedule("b", "other", "keyboard", 0, None)
+        self.assertEqual(bot.edits, [])
+        edits.close()
+        self.assertEqual(sorted(bot.edits), [("a", "text 2", "keyboard"), ("b", "other", "keyboard")])
+
+    def test_unchanged(self):
+        bot = RecordingBot()
+        edits = telegram.EditScheduler(bot, 60)
+        edits.schedule("a", "text 1", "keyboard", 1, 0)
+        edits.schedule("a", "text 0", "keyboard", 0, 1)
+        edits.close()
+        self.assertEqual(bot.edits, [])
+
+    def test_delay(self):
+        bot = RecordingBot()
+        edits = telegram.EditScheduler(bot, 0.01)
+        edits.schedule("a", "text", "keyboard")
+        for _ in range(100):
+            if bot.edits:
+                break
+            time.sleep(0.01)
+        self.assertEqual(bot.edits, [("a", "text", "keyboard")])
+        self.assertEqual(edits.pending, {})
+
+
+@unittest.skipIf(telegram is None, "telepot is not installed")
+class TestRender(unittest.TestCase):
+    def setUp(self):
+        self.handler = telegram.HordagoTelegramHandler("0:test")
+
+    def assertFresh(self, game):
+        message = self.handler.compute_message(game)
+        self.handler.fragments.clear()
+        self.assertEqual(message, self.handler.compute_message(game))
+
+    def test_fragments(self):
+        for seed in range(10):
+            policies = [simulator.RandomPolicy() for _ in range(4)]
+            game = simulator.new_game(policies, seed)
+            while not (game.current == "Finished" and game.players.has_finished()):
+                self.handler.compute_message(game)
+                simulator.play_move(game, policies)
+                self.assertFresh(game)
+        self.assertTrue(self.handler.fragments)
+
+    def test_refused(self):
+        policies = [simulator.RandomPolicy() for _ in range(4)]
+        game = simulator.new_game(policies, 1)
+        while game.current != "Haundia":
+            simulator.play_move(game, policies)
+        # A copy plays other actions, as a click whose save is refused would
+        refused = codec.decode(codec.encode(game))
+        for seed, played in [(0, refused), (5, game)]:
+            policies = [simulator.RandomPolicy() for _ in range(4)]
+            for policy in policies:
+                policy.start(seed)
+            while played.current == "Haundia":
+                simulator.play_move(played, policies)
+            self.handler.compute_message(played)
+        self.assertEqual((refused.current, game.current), ("Tipia", "Tipia"))
+        self.assertNotEqual(refused.states["Haundia"].history, game.states["Haundia"].history)
+        self.assertFresh(game)
+
+    def test_keyboards(self):
+        policies = [simulator.RandomPolicy() for _ in range(4)]
+        game = simulator.new_game(policies, 0)
+        while not (game.current == "Finished" and game.players.has_finished()):
+            key = self.handler.keyboard_key(game)
+            markup = json.loads(self.handler.serialized[key])
+            self.assertEqual(markup["inline_keyboard"][0][0]["callback_data"],
+                             self.handler.compute_keyboard(game).inline_keyboard[0][0].callback_data)
+            self.assertNotIn("url", markup["inline_keyboard"][0][0])
+            simulator.play_move(game, policies)
+
+
+@unittest.skipIf(telegram is None, "telepot is not installed")
+class TestInterface(unittest.TestCase):
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "interface.yaml")
+            with open(path, "w") as f:
+                f.write("texts:\n    title: first\n")
+            self.assertEqual(telegram.load_interface(path), {"texts": {"title": "first"}})
+
+            # Read from the pickle while the file keeps its modification time
+            cache = os.path.join(directory, "interface.pickle")
+            with open(cache, "rb") as f:
+                stamp, _ = pickle.load(f)
+            with open(cache, "wb") as f:
+                pickle.dump((stamp, {"cached": True}), f)
+            self.assertEqual(telegram.load_interface(path), {"cached": True})
+
+            with open(path, "w") as f:
+                f.write("texts:\n    title: second\n")
+            os.utime(path, ns=(stamp[0] + 10**9, stamp[0] + 10**9))
+            self.assertEqual(telegram.load_interface(path), {"texts": {"title": "second"}})
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registered = list(metrics.REGISTRY)
+
+    def tearDown(self):
+        metrics.REGISTRY[:] = self.registered
+
+    def test_histogram(self):
+        histogram = metrics.Histogram("test_seconds", "Test.", ["step"], buckets=(.1, 1.))
+        histogram.observe(.05, "a")
+        histogram.observe(.5, "a")
+        histogram.observe(5, "a")
+        self.assertEqual(histogram.count("a"), 3)
+        self.assertEqual(histogram.expose().splitlines(), [
+            "# HELP test_seconds Test.",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{step="a",le="0.1"} 1',
+            'test_seconds_bucket{step="a",le="1.0"} 2',
+            'test_seconds_bucket{step="a",le="+Inf"} 3',
+            'test_seconds_sum{step="a"} 5.55',
+            'test_seconds_count{step="a"} 3',
+        ])
+
+    def test_counter(self):
+        counter = metrics.Counter("test_total", "Test.", ["name"])
+        counter.inc('say "hi"\n')
+        counter.inc('say "hi"\n', amount=2)
+        self.assertEqual(counter.expose().splitlines()[-1], 'test_total{name="say \\"hi\\"\\n"} 3')
+
+    def test_serve(self):
+        metrics.Counter("test_served_total", "Test.").inc()
+        server = metrics.serve(0)
+        try:
+            with urllib.request.urlopen("http://127.0.0.1:{}/metrics".format(server.server_address[1])) as response:
+                body = response.read().decode("utf-8")
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn("test_served_total 1\n", body)
+        self.assertIn("# TYPE hordago_callback_seconds histogram", body)
+
+    @unittest.skipIf(telegram is None, "telepot is not installed")
+    def test_handler(self):
+        handler = telegram.HordagoTelegramHandler("0:test", telegram.HordagoDatabase(storage.MemoryStorage()))
+        handler.bot = handler.edits.bot = RecordingBot()
+        actions, stores = metrics.ACTIONS.count("add_player"), metrics.STORAGE.count("store")
+        unchanged = metrics.EDITS.get("unchanged")
+
+        game = handler.database.new_game("game")
+        event, _ = handler.play(game, 1, "Ane", "add_player.0")
+        handler.update_text("game", game, event)
+        handler.update_text("game", game, None, telegram.render_digest(handler.compute_message(game),
+                                                                          handler.keyboard_key(game)))
+        self.assertEqual(metrics.ACTIONS.count("add_player"), actions + 1)
+        self.assertEqual(metrics.STORAGE.count("store"), stores + 3)
+        self.assertEqual(metrics.EDITS.get("unchanged"), unchanged + 1)
+
+
+class SlowHandler:
+    """Stands for HordagoTelegramHandler and its game, with updates that take `sleep` seconds."""
+
+    def __init__(self):
+        self.game = Game("game")
+        self.handling = threading.local()
+
+    def on_callback_query(self, msg):
+        self.handling.state = self.game.current
+        time.sleep(msg.get("sleep", 0))
+        self.game.current = msg.get("next", self.game.current)
+
+    on_chosen_inline_result = on_callback_query
+
+
+class TestSlowCallbackProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.handler = SlowHandler()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def click(self, sleep=0, **msg):
+        self.handler.on_callback_query(dict(msg, inline_message_id="game", data="mus", sleep=sleep))
+
+    def profiles(self):
+        return sorted(os.listdir(self.directory.name))
+
+    def test_profile(self):
+        profiler.SlowCallbackProfiler(self.handler, self.directory.name, threshold=0.05, count=2, cooldown=0)
+        self.click()
+        self.assertEqual(self.profiles(), [])
+        self.click(0.1, next="Speaking")
+        for _ in range(3):
+            self.click()
+        profiles = self.profiles()
+        self.assertEqual(len(profiles), 4)
+        with open(os.path.join(self.directory.name, profiles[0])) as f:
+            update = json.load(f)
+        self.assertEqual((update["game_id"], update["state"], update["action"]), ("game", "Speaking", "mus"))
+        self.assertGreater(update["trigger"]["seconds"], 0.05)
+        # The state the slow update was played on
+        self.assertEqual(update["trigger"]["state"], "waiting_room")
+
+    def test_cooldown(self):
+        profiler.SlowCallbackProfiler(self.handler, self.directory.name, threshold=0.05, count=1, cooldown=60)
+        with self.assertLogs(level="WARNING") as logs:
+            for _ in range(3):
+                self.click(0.1)
+        # Armed once, by the first slow update, then cooling down
+        self.assertEqual(len([line for line in logs.output if "Slow" in line]), 1)
+        with open(os.path.join(self.directory.name, self.profiles()[0])) as f:
+            update = json.load(f)
+        self.assertEqual((update["state"], update["trigger"]["state"]), ("waiting_room", "waiting_room"))
+
+    def test_sample_rate(self):
+        profiler.SlowCallbackProfiler(self.handler, self.directory.name, threshold=0.05, sample_rate=0)
+        self.click(0.1)
+        self.click()
+        self.assertEqual(self.profiles(), [])
+
+
+class LegacyPickler(pickle.Pickler):
+    """Pickles a game in the layout of the code before cards were interned and players indexed."""
+
+    def reducer_override(self, obj):
+        if isinstance(obj, Card):
+            return copyreg.__newobj__, (Card,), {"value": obj.value, "color": obj.color}
+        if isinstance(obj, mus.Packet):
+            return copyreg.__newobj__, (mus.Packet,), {"unused_cards": obj.unused_cards, "used_cards": obj.used_cards}
+        if isinstance(obj, mus.PlayerManager):
+            state = {name: getattr(obj, name) for name in ("teams", "echku", "authorised_team", "authorised_player")}
+            return copyreg.__newobj__, (mus.PlayerManager,), state
+        if isinstance(obj, mus.Player):
+            # waiting_confirmation was only set once a hand was finished
+            state = {name: value for name, value in vars(obj).items()
+                     if name != "manager" and (name != "waiting_confirmation" or value)}
+            state["is_authorised"] = obj.is_authorised
+            return copyreg.__newobj__, (mus.Player,), state
+        if isinstance(obj, mus.BetState):
+            state = {name: value for name, value in vars(obj).items() if name not in ("ranking", "first_player")}
+            return copyreg.__newobj__, (type(obj),), state
+        return NotImplemented
+
+
+class TestLegacyPickle(unittest.TestCase):
+    def legacy(self, game):
+        f = io.BytesIO()
+        LegacyPickler(f).dump(game)
+        self.assertNotIn(b"ranking", f.getvalue())
+        return pickle.loads(f.getvalue())
+
+    def test_waiting_room(self):
+        game = Game("-42")
+        game.do("add_player", 1, "Léa", "0")
+        game.do("add_player", 2, "Ion", "1")
+        loaded = self.legacy(game)
+        self.assertEqual([player.name for player in loaded.players], ["Léa", "Ion"])
+        decoded = codec.decode(codec.encode(loaded))
+        self.assertEqual([player.name for player in decoded.players], ["Léa", "Ion"])
+        loaded.do("start", 1)
+        self.assertEqual(loaded.current, "Speaking")
+
+    def test_play_on(self):
+        policies = [simulator.RandomPolicy() for _ in range(4)]
+        game = simulator.new_game(policies, seed=3)
+        while game.current not in Game.bet_states or not game.state.history:
+            simulator.play_move(game, policies)
+        loaded = self.legacy(game)
+        self.assertEqual(loaded.state.players_authorised(), game.state.players_authorised())
+        self.assertEqual([player.cards for player in loaded.players.get_all_echku_sorted()],
+                         [player.cards for player in game.players.get_all_echku_sorted()])
+        self.assertEqual(codec.decode(codec.encode(loaded)).state.history, game.state.history)
+        while loaded.current != "Finished":
+            simulator.play_move(loaded, policies)
+        in_hands = [card.index() for player in loaded.players.get_all() for card in player.cards]
+        self.assertCountEqual(loaded.packet.unused_cards + loaded.packet.used_cards + in_hands, range(40))
+
+    @unittest.skipIf(telegram is None, "telepot is not installed")
+    def test_snapshot_log(self):
+        policies = [simulator.RandomPolicy() for _ in range(2)]
+        game = simulator.new_game(policies, seed=4)
+        game.game_id = "game"
+        while game.current != "Finished":
+            simulator.play_move(game, policies)
+        f = io.BytesIO()
+        LegacyPickler(f).dump(game)
+        self.assertEqual(pickle.loads(f.getvalue()).packet.seed, pickle.loads(f.getvalue()).packet.seed)
+
+        backend = storage.MemoryStorage()
+        backend.store("game", f.getvalue(), reset=True)
+        database = telegram.HordagoDatabase(backend, snapshot_every=5)
+        loaded = database.get("game").game
+        for player in loaded.players.get_all():
+            loaded.do("ok", player.id)
+            database.save(loaded, (player.id, "ok"))
+        self.assertEqual(loaded.current, "Speaking")
+        self.assertTrue(codec.is_encoded(backend.load("game")[0]))
+        for _ in range(2):
+            reloaded = telegram.HordagoDatabase(backend, snapshot_every=5).get("game").game
+            self.assertEqual([player.cards for player in reloaded.players.get_all()],
+                             [player.cards for player in loaded.players.get_all()])
+
+
 if __name__ == '__main__':
     unittest.main()